@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import extraction_cache
+import gemini_pool
+import metrics
+from gemini_service import (
+    GEMINI_RETRY,
+    TRANSCRIBE_PROMPT,
+    _fallback_task,
+    _cache_key,
+    _cached_tasks,
+    _parse_tasks,
+    _resolve_session,
+    _rules_task,
+    _tasks_prompt,
+)
+
+logger = logging.getLogger(__name__)
+
+# Versión asíncrona de gemini_service. Generar usa generate_content_async
+# sobre el cliente asíncrono de la key (gemini_pool), así una llamada de
+# varios segundos no congela el bot para el resto de usuarios. La subida
+# de ficheros no tiene versión asíncrona en la librería y va a un pool de
+# hilos propio y acotado.
+
+# Llamadas a Gemini en vuelo a la vez (todas las keys)
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "64"))
+# Segundos máximos por intento; un intento agotado cuenta como reintentable
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "15"))
+UPLOAD_WORKERS = int(os.getenv("GEMINI_UPLOAD_WORKERS", "4"))
+
+_slots = asyncio.Semaphore(GEMINI_CONCURRENCY)
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="gemini_upload")
+
+# Llamadas en curso por usuario, para poder cancelarlas con /cancelar
+_inflight = {}
+# Tareas canceladas por cancel_user (y no por el apagado del bot)
+_user_cancelled = set()
+
+class GeminiCancelled(Exception):
+    """El usuario canceló la llamada a Gemini antes de que terminara."""
+
+async def _with_timeout(func, *args):
+    async with _slots:
+        return await asyncio.wait_for(func(*args), GEMINI_TIMEOUT)
+
+async def _generate(session, contents):
+    model = session.gemini_model
+    started = time.monotonic()
+    with gemini_pool.in_use(session.gemini_api_key):
+        response = await GEMINI_RETRY.acall(_with_timeout, model.generate_content_async, contents)
+    metrics.observe("gemini.latency_ms", (time.monotonic() - started) * 1000)
+    return response
+
+async def _upload(session, path):
+    loop = asyncio.get_running_loop()
+
+    async def attempt(path):
+        # Cancelar no detiene el hilo: la subida en curso termina y se descarta
+        return await loop.run_in_executor(_upload_executor, session.gemini_clients.upload_file, path)
+
+    with gemini_pool.in_use(session.gemini_api_key):
+        return await GEMINI_RETRY.acall(_with_timeout, attempt, path)
+
+async def _tracked(user_id, coro):
+    """
+    Ejecuta coro como tarea registrada a nombre del usuario. Si se cancela
+    con cancel_user se lanza GeminiCancelled; si lo que se cancela es el
+    propio handler (apagado del bot), la cancelación se propaga tal cual.
+    """
+    task = asyncio.ensure_future(coro)
+    _inflight.setdefault(user_id, set()).add(task)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if task not in _user_cancelled:
+            raise
+        metrics.incr("gemini.cancelled")
+        raise GeminiCancelled() from None
+    finally:
+        _user_cancelled.discard(task)
+        tasks = _inflight.get(user_id)
+        if tasks is not None:
+            tasks.discard(task)
+            if not tasks:
+                del _inflight[user_id]
+
+def cancel_user(user_id):
+    """Cancela las llamadas a Gemini en curso del usuario. Retorna cuántas había."""
+    tasks = [task for task in _inflight.get(user_id, ()) if not task.done()]
+    for task in tasks:
+        _user_cancelled.add(task)
+        task.cancel()
+    return len(tasks)
+
+def cancel_all():
+    for user_id in list(_inflight):
+        cancel_user(user_id)
+
+def inflight_count():
+    return sum(len(tasks) for tasks in _inflight.values())
+
+async def get_chat_response(message, user_id=None, session=None):
+    """Como gemini_service.get_chat_response, con await."""
+    session = _resolve_session(user_id, session)
+    if not session.gemini_api_key:
+        return "❌ No tienes configurada tu API key de Gemini. Usa /config para configurarla."
+
+    async def run():
+        response = await _generate(session, message)
+        return response.text
+
+    try:
+        return await _tracked(session.user_id, run())
+    except GeminiCancelled:
+        raise
+    except asyncio.TimeoutError:
+        return "⏱️ Gemini tardó demasiado en responder. Intenta de nuevo."
+    except Exception as e:
+        return f"Error al conectar con Gemini: {e}"
+
+def _chunk_text(chunk):
+    # .text lanza ValueError si el trozo no trae texto (p. ej. solo metadatos de seguridad)
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+async def stream_chat_response(message, on_text, user_id=None, session=None):
+    """
+    Como get_chat_response, pero en streaming: llama a await on_text(texto)
+    con el texto acumulado cada vez que llega un trozo. Retorna el texto
+    final (o el mensaje de error, como get_chat_response). Solo se
+    reintenta antes del primer trozo; si la respuesta se corta a medias se
+    devuelve lo recibido con un aviso.
+    """
+    session = _resolve_session(user_id, session)
+    if not session.gemini_api_key:
+        return "❌ No tienes configurada tu API key de Gemini. Usa /config para configurarla."
+    model = session.gemini_model
+
+    async def open_stream():
+        return await asyncio.wait_for(model.generate_content_async(message, stream=True), GEMINI_TIMEOUT)
+
+    async def run():
+        text = ""
+        started = time.monotonic()
+        with gemini_pool.in_use(session.gemini_api_key):
+            async with _slots:
+                try:
+                    response = await GEMINI_RETRY.acall(open_stream)
+                    chunks = response.__aiter__()
+                    while True:
+                        try:
+                            # El plazo cuenta entre trozos, no para la respuesta entera
+                            chunk = await asyncio.wait_for(anext(chunks), GEMINI_TIMEOUT)
+                        except StopAsyncIteration:
+                            break
+                        piece = _chunk_text(chunk)
+                        if not piece:
+                            continue
+                        if not text:
+                            metrics.observe("gemini.first_chunk_ms", (time.monotonic() - started) * 1000)
+                        text += piece
+                        await on_text(text)
+                except Exception as e:
+                    if not text:
+                        raise
+                    logger.warning(f"Streaming de Gemini cortado tras {len(text)} caracteres: {e!r}")
+                    return text + "\n\n⚠️ Respuesta incompleta (se cortó la conexión con Gemini)."
+        metrics.observe("gemini.latency_ms", (time.monotonic() - started) * 1000)
+        return text or "🤔 Gemini no devolvió texto."
+
+    try:
+        return await _tracked(session.user_id, run())
+    except GeminiCancelled:
+        raise
+    except asyncio.TimeoutError:
+        return "⏱️ Gemini tardó demasiado en responder. Intenta de nuevo."
+    except Exception as e:
+        return f"Error al conectar con Gemini: {e}"
+
+async def extract_tasks(text, user_id=None, session=None):
+    """
+    Extrae una o varias tareas del texto ("comprar leche, llamar al banco y
+    reservar vuelo para el viernes"). Prueba antes las reglas y la caché;
+    solo si no bastan pregunta a Gemini.
+    Retorna una lista de diccionarios (al menos uno) con las claves de
+    gemini_service.extract_task_info.
+    """
+    task = _rules_task(text)
+    if task:
+        return [task]
+    key = _cache_key("tasks", text)
+    cached = _cached_tasks(key)
+    if cached:
+        return cached
+    session = _resolve_session(user_id, session)
+    if not session.gemini_api_key:
+        logger.warning("No hay API key de Gemini configurada")
+        return [_fallback_task(text)]
+
+    async def run():
+        response = await _generate(session, _tasks_prompt(text))
+        tasks = _parse_tasks(response.text)
+        if tasks:
+            extraction_cache.get_cache().put(key, tasks)
+        return tasks or [_fallback_task(text)]
+
+    try:
+        return await _tracked(session.user_id, run())
+    except GeminiCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Error extrayendo tareas con Gemini: {e!r}")
+        return [_fallback_task(text)]
+
+async def transcribe_audio(audio_file_path, user_id=None, session=None):
+    """Como gemini_service.transcribe_audio, con await."""
+    session = _resolve_session(user_id, session)
+    if not session.gemini_api_key:
+        logger.warning("No hay API key de Gemini configurada")
+        return None
+
+    async def run():
+        audio_file = await _upload(session, audio_file_path)
+        response = await _generate(session, [TRANSCRIBE_PROMPT, audio_file])
+        return response.text.strip()
+
+    try:
+        return await _tracked(session.user_id, run())
+    except GeminiCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Error transcribiendo audio: {e!r}")
+        return None
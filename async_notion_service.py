@@ -0,0 +1,590 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import aclosing
+from datetime import datetime, timezone
+import idempotency_ledger
+import metrics
+import notion_mirror
+import notion_schema
+import rate_limiter
+from client_pool import token_key
+from notion_service import (
+    NOTION_RETRY,
+    _anotion_call,
+    _build_properties,
+    _create_error_message,
+    _is_validation_error,
+    _mirror_write,
+    _page_summary,
+    _search_page_size,
+    _search_query,
+    _validate_status,
+)
+from retry_policy import _status_of
+from user_session import UserSession
+
+logger = logging.getLogger(__name__)
+
+# Búsqueda en todas las BDs del usuario: BDs consultadas a la vez y
+# segundos máximos de espera antes de responder con lo que haya
+FANOUT_CONCURRENCY = int(os.getenv("NOTION_FANOUT_CONCURRENCY", "4"))
+FANOUT_TIMEOUT = float(os.getenv("NOTION_FANOUT_TIMEOUT", "8"))
+# Constante de reciprocal rank fusion (valor habitual en la literatura)
+RRF_K = 60
+# Segundos que se recuerda si un token puede leer una BD del espejo
+MIRROR_ACCESS_TTL = float(os.getenv("NOTION_MIRROR_ACCESS_TTL", "300"))
+MIRROR_ACCESS_MAX = 4096
+# Códigos con los que Notion dice que el token no ve la BD
+NO_ACCESS_STATUS = (401, 403, 404)
+
+# Versión asíncrona de notion_service sobre notion_client.AsyncClient.
+# Los handlers de main.py la usan con await, así una llamada lenta a Notion
+# no congela el bot para el resto de usuarios.
+
+# Lecturas de esquema en curso: las peticiones concurrentes a la misma BD
+# esperan la misma respuesta en vez de gastar cupo de rate limit cada una
+_schema_inflight = {}
+
+async def get_schema(session, database_id=None, refresh=False):
+    """Esquema de la BD (por defecto la activa), desde la caché compartida."""
+    database_id = database_id or session.database_id
+    if not refresh:
+        schema = notion_schema.get_cached(database_id)
+        if schema:
+            return schema
+    
+    inflight = _schema_inflight.get(database_id)
+    if inflight is not None:
+        return await asyncio.shield(inflight)
+    
+    async def fetch():
+        db = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.databases.retrieve,
+            database_id=database_id
+        )
+        return notion_schema.put(database_id, db)
+    
+    task = asyncio.ensure_future(fetch())
+    _schema_inflight[database_id] = task
+    try:
+        return await asyncio.shield(task)
+    finally:
+        if task.done():
+            _schema_inflight.pop(database_id, None)
+        else:
+            task.add_done_callback(lambda _: _schema_inflight.pop(database_id, None))
+
+def check_session(session):
+    """Mensaje de error si la sesión no tiene token o BD activa, o None."""
+    if not session.notion_token:
+        logger.error("NOTION_TOKEN no configurado")
+        return "❌ Error: No tienes configurado tu token de Notion. Usa /config"
+    if not session.database_id:
+        logger.error("No hay database_id configurado")
+        return "❌ Error: No tienes bases de datos configuradas. Usa /add_db"
+    return None
+
+async def _load_create_schema(session, database_id):
+    try:
+        return await get_schema(session, database_id)
+    except Exception as e:
+        logger.warning(f"No se pudo leer el esquema de {database_id}: {e}")
+        return None
+
+def _payload_value(encoded):
+    """Valor en texto de una propiedad tal como se envía a pages.create (como _plain_value)."""
+    prop_type, value = next(iter(encoded.items()))
+    return notion_mirror._plain_value({"type": prop_type, prop_type: (
+        [{"plain_text": part["text"]["content"]} for part in value]
+        if prop_type in ("title", "rich_text") else value
+    )})
+
+def _matches_payload(page, properties):
+    """True si la página tiene en cada propiedad enviada el mismo valor."""
+    page_properties = page.get("properties", {})
+    for name, encoded in properties.items():
+        prop = page_properties.get(name)
+        if prop is None or notion_mirror._plain_value(prop) != _payload_value(encoded):
+            return False
+    return True
+
+async def _find_recent_page(session, database_id, title_property, properties, since):
+    """
+    Página creada desde since (epoch de la petición) con exactamente las
+    propiedades de properties, o None. No adopta páginas que ya están en el
+    ledger: esas las creó otra petición.
+    """
+    title = _payload_value(properties[title_property]) if title_property in properties else None
+    # Notion da created_time redondeado al minuto: el filtro tiene que
+    # empezar en el minuto de since para incluir una página creada en él
+    since_iso = datetime.fromtimestamp(since, timezone.utc).replace(second=0, microsecond=0).isoformat()
+    conditions = [{"timestamp": "created_time", "created_time": {"on_or_after": since_iso}}]
+    if title:
+        conditions.append({"property": title_property, "title": {"equals": title}})
+    response = await session.notion_async_client.databases.query(
+        database_id=database_id,
+        filter={"and": conditions},
+        page_size=25
+    )
+    ledger = idempotency_ledger.get_ledger()
+    for page in response.get("results", []):
+        if _matches_payload(page, properties) and not ledger.has_page(page["id"]):
+            return page
+    return None
+
+async def _create_request(session, schema, properties, title, reconcile_since=None):
+    """
+    pages.create con reintentos sin duplicar: un intento que agotó el
+    timeout pudo crear la página en Notion, así que antes de repetirlo se
+    busca una página con las mismas propiedades (título, fecha,
+    descripción, estado...) creada desde el primer intento.
+    reconcile_since fuerza esa comprobación ya en el primer intento (el
+    outbox lo usa al repetir una entrada que falló antes).
+    """
+    database_id = session.database_id
+    title_property = (schema.role_property("title") if schema else None) or notion_schema.TITLE_PROPERTY
+    since = reconcile_since or time.time()
+    bucket = rate_limiter.for_notion_token(session.notion_token)
+    attempts = 0
+
+    async def attempt():
+        nonlocal attempts
+        if attempts or reconcile_since:
+            await bucket.acquire_async()
+            existing = await _find_recent_page(session, database_id, title_property, properties, since)
+            if existing:
+                metrics.incr("notion_ledger.reconciled")
+                logger.warning(f"'{title}' ya estaba creada en Notion ({existing['id']}), no se repite")
+                return existing
+        attempts += 1
+        return await session.notion_async_client.pages.create(
+            parent={"database_id": database_id},
+            properties=properties
+        )
+
+    return await _anotion_call(session.notion_token, attempt)
+
+async def _create_one(session, schema, title, description=None, date=None, status=None, type_val=None,
+                      raise_retryable=False, idem_key=None, reconcile_since=None):
+    """
+    Crea una página en la BD activa con el esquema ya leído.
+    Retorna (respuesta de Notion o None, mensaje para el usuario).
+    Con raise_retryable=True los errores transitorios se propagan (el
+    outbox los reintenta más tarde) en vez de convertirse en mensaje.
+    idem_key identifica la petición (p. ej. el update de Telegram); sin
+    ella se usa una clave por contenido. Si la clave ya creó una página,
+    se devuelve esa en vez de escribir otra vez.
+    """
+    database_id = session.database_id
+    ledger = idempotency_ledger.get_ledger()
+    if idem_key is None:
+        idem_key = idempotency_ledger.content_key(session.user_id, database_id, [
+            title, description, date, status, type_val
+        ])
+    existing = ledger.get(idem_key)
+    if existing:
+        logger.info(f"Página ya creada para {idem_key}: {existing['id']}")
+        return existing, f"✅ Página creada: {title}\n🔗 {existing['url']}"
+
+    try:
+        logger.info(f"Creando página: '{title}' en DB {database_id}")
+
+        error = _validate_status(schema, status)
+        if error:
+            return None, error
+
+        properties = _build_properties(
+            schema,
+            title=title,
+            description=description,
+            date=date,
+            status=status,
+            type_val=type_val
+        )
+
+        response = await _create_request(session, schema, properties, title, reconcile_since)
+
+        logger.info(f"Página creada exitosamente: {response['id']}")
+        ledger.record(idem_key, session.user_id, response["id"], response.get("url"))
+        _mirror_write(response, database_id)
+        return response, f"✅ Página creada: {title}\n🔗 {response['url']}"
+
+    except Exception as e:
+        if raise_retryable and NOTION_RETRY.is_retryable(e):
+            raise
+        logger.error(f"Error creando página: {e}", exc_info=True)
+
+        if _is_validation_error(e):
+            # El esquema en caché puede estar desactualizado
+            notion_schema.invalidate(database_id)
+
+        return None, _create_error_message(e, status)
+
+def format_created_summary(items):
+    """
+    Mensaje resumen de un lote de creaciones.
+    items: [(título, url o None si falló, mensaje)].
+    """
+    created = sum(1 for _, url, _ in items if url)
+    msg = f"✅ {created} de {len(items)} tareas creadas:\n"
+    for title, url, message in items:
+        if url:
+            msg += f"\n• {title}\n  🔗 {url}"
+        else:
+            msg += f"\n• {title}: {message}"
+    return msg
+
+async def iter_search_pages(query, session=None, page_size=100, database_id=None):
+    """
+    Genera (async) las páginas cuyo título contiene query, filtrando en
+    Notion y pidiendo la siguiente página de resultados solo si hace falta.
+    Por defecto busca en la BD activa de la sesión.
+    """
+    if session is None:
+        session = UserSession.resolve()
+
+    database_id = database_id or session.database_id
+    if not session.notion_token or not database_id:
+        return
+
+    cursor = None
+    while True:
+        # El cliente se pide en cada página: entre una y otra el generador
+        # puede quedar parado y el pool cambiarlo
+        response = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.databases.query,
+            **_search_query(database_id, query, page_size, cursor)
+        )
+        for page in response.get("results", []):
+            yield _page_summary(page)
+        cursor = response.get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            return
+
+# Syncs del espejo en curso por BD (incluye backfills en segundo plano)
+_sync_tasks = {}
+
+async def _run_mirror_sync(session, database_id, kind, query_filter):
+    """Trae de Notion las páginas nuevas o editadas y las guarda en el espejo."""
+    mirror = notion_mirror.get_mirror()
+    started = time.monotonic()
+    newest = None
+    seen = []
+    fetched = 0
+    cursor = None
+    while True:
+        kwargs = {"database_id": database_id, "page_size": 100}
+        if query_filter:
+            kwargs["filter"] = query_filter
+        if cursor:
+            kwargs["start_cursor"] = cursor
+        response = await _anotion_call(
+            session.notion_token, session.notion_async_client.databases.query, **kwargs
+        )
+        results = response.get("results", [])
+        mirror.upsert_pages(database_id, results)
+        fetched += len(results)
+        for page in results:
+            edited = page.get("last_edited_time")
+            if edited and (newest is None or edited > newest):
+                newest = edited
+            if kind == "full":
+                seen.append(page["id"])
+        cursor = response.get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            break
+    removed = mirror.remove_missing(database_id, seen) if kind == "full" else 0
+    mirror.mark_synced(database_id, newest, full=(kind == "full"))
+    metrics.incr(f"notion_mirror.sync_{kind}")
+    metrics.observe("notion_mirror.sync_ms", (time.monotonic() - started) * 1000)
+    logger.info(f"Espejo de {database_id}: sync {kind}, {fetched} página(s), {removed} borrada(s)")
+    return fetched
+
+def _start_mirror_sync(session, database_id, full=False):
+    """Lanza (o reutiliza) el sync del espejo de una BD; devuelve la tarea o None."""
+    mirror = notion_mirror.get_mirror()
+    key = notion_mirror.normalize_id(database_id)
+    task = _sync_tasks.get(key)
+    if task is not None:
+        return task
+    kind, query_filter = ("full", None) if full else mirror.sync_plan(database_id)
+    if kind is None:
+        return None
+    task = asyncio.ensure_future(_run_mirror_sync(session, database_id, kind, query_filter))
+    _sync_tasks[key] = task
+
+    def done(t):
+        _sync_tasks.pop(key, None)
+        if not t.cancelled() and t.exception():
+            logger.error(f"Error sincronizando espejo de {database_id}: {t.exception()}")
+    task.add_done_callback(done)
+    return task
+
+async def sync_mirror(session, database_id=None, full=False):
+    """Sincroniza el espejo de la BD (por defecto la activa) y espera a que acabe."""
+    task = _start_mirror_sync(session, database_id or session.database_id, full)
+    if task is None:
+        return 0
+    return await asyncio.shield(task)
+
+# (token_key, BD) -> (acceso permitido, instante en que caduca)
+_mirror_access = {}
+
+async def _has_access(session, database_id):
+    """
+    True si el token de la sesión puede leer la BD. El espejo es compartido:
+    sin esta comprobación, un usuario podría leer desde el espejo una BD
+    que sincronizó otro y que su integración no tiene compartida.
+    La respuesta de databases.retrieve se recuerda MIRROR_ACCESS_TTL segundos.
+    """
+    key = (token_key(session.notion_token), notion_mirror.normalize_id(database_id))
+    now = time.monotonic()
+    cached = _mirror_access.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    try:
+        db = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.databases.retrieve,
+            database_id=database_id
+        )
+    except Exception as e:
+        if _status_of(e) not in NO_ACCESS_STATUS:
+            # Fallo transitorio: no se recuerda, esta vez se consulta Notion
+            logger.warning(f"No se pudo comprobar el acceso a {database_id}: {e}")
+            return False
+        allowed = False
+    else:
+        notion_schema.put(database_id, db)
+        allowed = True
+    if len(_mirror_access) >= MIRROR_ACCESS_MAX:
+        _mirror_access.clear()
+    _mirror_access[key] = (allowed, now + MIRROR_ACCESS_TTL)
+    return allowed
+
+async def _mirror_ready(session, database_id):
+    """
+    True si se puede responder desde el espejo: el token tiene acceso a la
+    BD y el espejo está al día. Si la BD nunca se sincronizó, lanza el
+    backfill en segundo plano y devuelve False (se consulta Notion).
+    """
+    mirror = notion_mirror.get_mirror()
+    if mirror is None or not session.notion_token or not database_id:
+        return False
+    if not await _has_access(session, database_id):
+        return False
+    if not mirror.is_ready(database_id):
+        _start_mirror_sync(session, database_id)
+        return False
+    kind, _ = mirror.sync_plan(database_id)
+    if kind == "full":
+        # Resync completo periódico: en segundo plano, el espejo sigue sirviendo
+        _start_mirror_sync(session, database_id)
+        return True
+    try:
+        await sync_mirror(session, database_id)
+    except Exception as e:
+        logger.warning(f"Sync incremental fallido, se consulta Notion directamente: {e}")
+        return False
+    return True
+
+def _mirror_summary(page):
+    return {"id": page["id"], "title": page["title"], "url": page["url"]}
+
+async def _search_database(session, database_id, query, limit, fuzzy=False):
+    """Busca en una BD concreta: espejo si está listo, si no Notion en vivo."""
+    results = []
+    if await _mirror_ready(session, database_id):
+        mirror = notion_mirror.get_mirror()
+        if not fuzzy:
+            results = [_mirror_summary(page) for page in mirror.search(database_id, query, limit)]
+        if not results:
+            results = mirror.fuzzy_search(database_id, query, limit)
+        return results
+    pages = iter_search_pages(query, session, page_size=_search_page_size(limit), database_id=database_id)
+    async with aclosing(pages):
+        async for page in pages:
+            results.append(page)
+            if len(results) >= limit:
+                break
+    return results
+
+async def search_pages(query, limit=10, session=None, fuzzy=False):
+    """
+    Busca páginas en la BD activa por título.
+    Retorna una lista de diccionarios con id, title, url.
+    Usa el espejo local si la BD ya está sincronizada. Con fuzzy=True (o si
+    la búsqueda normal no encuentra nada) devuelve títulos parecidos aunque
+    la consulta tenga erratas; esos resultados incluyen "similarity".
+    """
+    if session is None:
+        session = UserSession.resolve()
+
+    if limit <= 0:
+        return []
+    try:
+        return await _search_database(session, session.database_id, query, limit, fuzzy)
+    except Exception as e:
+        logger.error(f"Error buscando páginas: {e}")
+        return []
+
+async def search_all_databases(query, session, limit=10, fuzzy=False, timeout=FANOUT_TIMEOUT):
+    """
+    Busca a la vez en todas las BDs del usuario (como mucho FANOUT_CONCURRENCY
+    en paralelo) y mezcla los resultados por posición (reciprocal rank
+    fusion: los scores de BDs distintas no son comparables).
+    Cada resultado lleva "alias". Las BDs que fallan o no responden antes
+    de timeout se omiten.
+    Retorna (resultados, aliases sin respuesta).
+    """
+    databases = session.databases or {}
+    if not databases or not session.notion_token or limit <= 0:
+        return [], []
+
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def search_one(database_id):
+        async with semaphore:
+            return await _search_database(session, database_id, query, limit, fuzzy)
+
+    started = time.monotonic()
+    tasks = {asyncio.ensure_future(search_one(db_id)): alias for alias, db_id in databases.items()}
+    done, pending = await asyncio.wait(list(tasks), timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+    fused = {}
+    failed = [tasks[task] for task in pending]
+    # En el orden de los alias, para que los empates salgan siempre igual
+    for task, alias in tasks.items():
+        if task not in done:
+            continue
+        if task.exception():
+            logger.error(f"Error buscando en la BD '{alias}': {task.exception()}")
+            failed.append(alias)
+            continue
+        for rank, hit in enumerate(task.result()):
+            key = notion_mirror.normalize_id(hit["id"])
+            score = 1 / (RRF_K + rank)
+            if key in fused:
+                # Misma página alcanzable desde dos alias
+                fused[key][0] += score
+            else:
+                fused[key] = [score, dict(hit, alias=alias)]
+
+    metrics.observe("notion_fanout.latency_ms", (time.monotonic() - started) * 1000)
+    metrics.incr("notion_fanout.searches")
+    if failed:
+        metrics.incr("notion_fanout.partial")
+        logger.warning(f"Búsqueda en todas las BDs sin respuesta de: {', '.join(failed)}")
+    ranked = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+    return [hit for _, hit in ranked[:limit]], sorted(failed)
+
+async def list_pages(session, limit=10):
+    """Últimas tareas editadas de la BD activa (id, title, url)."""
+    if not session.notion_token or not session.database_id:
+        return []
+    if await _mirror_ready(session, session.database_id):
+        mirror = notion_mirror.get_mirror()
+        return [_mirror_summary(page) for page in mirror.list_pages(session.database_id, limit)]
+    try:
+        response = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.databases.query,
+            database_id=session.database_id,
+            sorts=[{"timestamp": "last_edited_time", "direction": "descending"}],
+            page_size=_search_page_size(limit)
+        )
+        return [_page_summary(page) for page in response.get("results", [])[:limit]]
+    except Exception as e:
+        logger.error(f"Error listando páginas: {e}")
+        return []
+
+async def get_page(session, page_id):
+    """
+    Página por ID desde el espejo (si el token tiene acceso a su BD); si no
+    está, se pide a Notion y se guarda.
+    """
+    if not session.notion_token:
+        return None
+    mirror = notion_mirror.get_mirror()
+    if mirror:
+        page = mirror.get_page(page_id)
+        if page and await _has_access(session, page["database_id"]):
+            return _mirror_summary(page)
+    try:
+        page = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.pages.retrieve,
+            page_id=page_id
+        )
+    except Exception as e:
+        logger.error(f"Error obteniendo página {page_id}: {e}")
+        return None
+    if mirror:
+        mirror.upsert_page(page)
+    return _page_summary(page)
+
+async def _page_database_id(session, page_id):
+    """BD a la que pertenece la página: del espejo o, si no está, preguntando a Notion."""
+    mirror = notion_mirror.get_mirror()
+    page = mirror.get_page(page_id) if mirror else None
+    if page:
+        database_id = page["database_id"]
+    else:
+        page = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.pages.retrieve,
+            page_id=page_id
+        )
+        database_id = page.get("parent", {}).get("database_id")
+    if database_id and session.database_id and (
+        notion_mirror.normalize_id(session.database_id) == notion_mirror.normalize_id(database_id)
+    ):
+        # Mismo ID escrito igual que en la sesión, para reutilizar su esquema en caché
+        return session.database_id
+    return database_id
+
+async def _update_one(session, page_id, fields, raise_retryable=False):
+    """
+    Aplica fields (title, description, date, status, type_val) a una página.
+    Retorna (respuesta de Notion o None, mensaje para el usuario).
+    """
+    database_id = None
+    try:
+        database_id = await _page_database_id(session, page_id)
+        schema = await _load_create_schema(session, database_id) if database_id else None
+        error = _validate_status(schema, fields.get("status"))
+        if error:
+            return None, error
+        properties = _build_properties(
+            schema,
+            title=fields.get("title"),
+            description=fields.get("description"),
+            date=fields.get("date"),
+            status=fields.get("status"),
+            type_val=fields.get("type_val")
+        )
+
+        response = await _anotion_call(
+            session.notion_token,
+            session.notion_async_client.pages.update,
+            page_id=page_id,
+            properties=properties
+        )
+        _mirror_write(response)
+        logger.info(f"Página {page_id} actualizada")
+        return response, "✅ Tarea actualizada correctamente."
+
+    except Exception as e:
+        if raise_retryable and NOTION_RETRY.is_retryable(e):
+            raise
+        logger.error(f"Error actualizando página: {e}")
+        if database_id and _is_validation_error(e):
+            # El esquema en caché puede estar desactualizado
+            notion_schema.invalidate(database_id)
+        return None, f"❌ Error al actualizar: {str(e)}"
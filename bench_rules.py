@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+import time
+from dotenv import load_dotenv
+import task_rules
+
+load_dotenv()
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_rules_corpus.txt")
+
+# Mide task_rules sobre un corpus de entradas reales de /plan (una por
+# línea): cuántas resuelve sin LLM y cuánto baja la latencia p50.
+# Sin corpus usa bench_rules_corpus.txt, con los ejemplos del README y
+# horas que las reglas deben dejar al LLM ("10am", "21h", "el 15").
+# Con --llm llama también a Gemini con la key global para comparar
+# latencias y comprobar que las tareas resueltas por reglas coinciden.
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def _llm_task(session, text):
+    from gemini_service import GEMINI_RETRY, _parse_tasks, _tasks_prompt
+    response = GEMINI_RETRY.call(session.gemini_model.generate_content, _tasks_prompt(text))
+    return _parse_tasks(response.text)
+
+def _same_task(rule_task, llm_tasks):
+    if len(llm_tasks) != 1:
+        return False
+    llm_task = llm_tasks[0]
+    return (
+        rule_task["title"].lower() == (llm_task.get("title") or "").lower()
+        and rule_task["date"] == llm_task.get("date")
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Tasa de acierto y latencia del extractor por reglas.")
+    parser.add_argument("corpus", nargs="?", default=DEFAULT_CORPUS,
+                        help="Fichero con una entrada de /plan por línea ('-' = stdin)")
+    parser.add_argument("--min-confidence", type=float, default=task_rules.MIN_CONFIDENCE)
+    parser.add_argument("--llm", action="store_true", help="Llama también a Gemini (key global) para comparar")
+    parser.add_argument("--misses", action="store_true", help="Lista las entradas que irían al LLM")
+    args = parser.parse_args()
+
+    source = sys.stdin if args.corpus == "-" else open(args.corpus, encoding="utf-8")
+    with source:
+        inputs = [line.strip() for line in source if line.strip()]
+    if not inputs:
+        print("Error: el corpus está vacío.", file=sys.stderr)
+        return 1
+
+    session = None
+    if args.llm:
+        from user_session import UserSession
+        session = UserSession.resolve(None)
+        if not session.gemini_api_key:
+            print("Error: --llm necesita GEMINI_API_KEY o DEFAULT_GEMINI_API_KEY.", file=sys.stderr)
+            return 1
+
+    rule_ms, llm_ms, pipeline_ms = [], [], []
+    hits = agree = 0
+    for text in inputs:
+        started = time.perf_counter()
+        task, confidence = task_rules.extract(text)
+        elapsed = (time.perf_counter() - started) * 1000
+        rule_ms.append(elapsed)
+        hit = task is not None and confidence >= args.min_confidence
+        hits += hit
+        if args.misses and not hit:
+            print(f"  [{confidence:.2f}] {text}")
+
+        if session:
+            started = time.perf_counter()
+            llm_tasks = _llm_task(session, text)
+            llm_elapsed = (time.perf_counter() - started) * 1000
+            llm_ms.append(llm_elapsed)
+            pipeline_ms.append(elapsed if hit else elapsed + llm_elapsed)
+            if hit and _same_task(task, llm_tasks):
+                agree += 1
+
+    total = len(inputs)
+    print(f"Entradas: {total}")
+    print(f"Resueltas por reglas: {hits} ({hits / total:.0%}) con confianza >= {args.min_confidence}")
+    print(f"Reglas: p50 {_percentile(rule_ms, 50):.3f} ms, p99 {_percentile(rule_ms, 99):.3f} ms")
+    if session:
+        llm_p50 = _percentile(llm_ms, 50)
+        pipeline_p50 = _percentile(pipeline_ms, 50)
+        print(f"Solo Gemini: p50 {llm_p50:.0f} ms")
+        print(f"Reglas + Gemini: p50 {pipeline_p50:.0f} ms (ganancia {llm_p50 - pipeline_p50:.0f} ms)")
+        if hits:
+            print(f"Coinciden con Gemini (título y fecha): {agree}/{hits} ({agree / hits:.0%})")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,7 @@ import os
 from notion_client import Client
 from dotenv import load_dotenv
 import config_manager
-import json
+import notion_schema
 
 load_dotenv()
 
@@ -20,51 +20,31 @@ def check_schema():
         return
 
     notion = Client(auth=NOTION_TOKEN)
-    
+
     print(f"Usando ID: {db_id}")
-    
+
     try:
-        # 1. Create dummy page
-        print("Creando página de prueba...")
-        new_page = notion.pages.create(
-            parent={"database_id": db_id},
-            properties={
-                "Name": { # Assuming 'Name' exists, usually safe. If fails, we'll know.
-                    "title": [
-                        {
-                            "text": {
-                                "content": "Test Schema Check"
-                            }
-                        }
-                    ]
-                }
-            }
-        )
-        
-        print("✅ Página creada. ID:", new_page["id"])
-        
-        # 2. Inspect properties in response
+        # Solo lectura: el esquema sale de databases.retrieve, sin páginas de prueba
+        schema = notion_schema.parse_schema(db_id, notion.databases.retrieve(database_id=db_id))
+
         print("\n🔍 Propiedades detectadas:")
-        props = new_page.get("properties", {})
-        for name, prop in props.items():
-            prop_type = prop.get("type")
-            print(f"- Nombre: '{name}' | Tipo: {prop_type}")
-            
-            # Print options for selects
-            if prop_type == "select":
-                # Select options are not in page response, sadly. They are in DB schema.
-                # But we can at least know the column exists.
-                pass
-        
-        # 3. Archive page
-        print("\nBorrando página de prueba...")
-        notion.pages.update(page_id=new_page["id"], archived=True)
-        print("✅ Página borrada.")
+        for name, prop in schema.properties.items():
+            print(f"- Nombre: '{name}' | Tipo: {prop['type']}")
+            if prop["options"]:
+                print(f"  Opciones: {', '.join(prop['options'])}")
+
+        print("\n🧭 Columnas que usará el bot:")
+        for role in notion_schema.ROLES:
+            mapped = schema.roles.get(role)
+            if mapped:
+                print(f"- {role}: '{mapped[0]}' ({mapped[1]})")
+            else:
+                print(f"- {role}: ❌ sin columna adecuada (se omitirá)")
 
     except Exception as e:
         print(f"\n❌ Error: {e}")
-        if "Name is not a property" in str(e):
-            print("💡 PISTA: La propiedad de título no se llama 'Name'.")
+        if "Could not find database" in str(e):
+            print("💡 PISTA: Comparte la base de datos con la integración.")
 
     print("--- FIN CHECK SCHEMA ---")
 
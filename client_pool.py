@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pool LRU + TTL de clientes por credencial, compartido por notion_pool y
+# gemini_pool: cada uno pone su factory, tamaño y nombre de métricas.
+
+def token_key(token):
+    """Clave estable para un token sin guardar el token en claro."""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+class ClientPool:
+    """
+    Pool acotado de clientes de una API por token o API key.
+    Reutiliza el cliente (y sus conexiones keep-alive) entre llamadas y
+    usuarios que comparten token. Expulsa por LRU al superar max_size y
+    descarta los clientes que llevan más de idle_ttl segundos sin usarse.
+    Nunca cierra un cliente con llamadas en curso (marcadas con in_use):
+    una exportación larga puede tener el mismo cliente ocupado minutos.
+    """
+
+    def __init__(self, factory, max_size, idle_ttl, name):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.name = name
+        self._clients = OrderedDict()  # token_key -> (cliente, último uso)
+        self._active = {}              # token_key -> llamadas en curso
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Devuelve el cliente del token, creándolo si no está en el pool."""
+        key = token_key(token)
+        now = time.monotonic()
+        with self._lock:
+            expired = self._expire(now)
+            entry = self._clients.pop(key, None)
+            if entry is not None:
+                client = entry[0]
+                metrics.incr(f"{self.name}.hits")
+            else:
+                client = self.factory(auth=token)
+                metrics.incr(f"{self.name}.misses")
+            self._clients[key] = (client, now)
+            expired.extend(self._evict(keep=key))
+        for old_client in expired:
+            self._close(old_client)
+        return client
+
+    @contextmanager
+    def in_use(self, token):
+        """Marca el cliente del token como ocupado mientras dura el bloque."""
+        key = token_key(token)
+        with self._lock:
+            self._active[key] = self._active.get(key, 0) + 1
+            self._touch(key)
+        try:
+            yield
+        finally:
+            with self._lock:
+                count = self._active.pop(key) - 1
+                if count:
+                    self._active[key] = count
+                self._touch(key)
+
+    def _touch(self, key):
+        entry = self._clients.get(key)
+        if entry is not None:
+            self._clients[key] = (entry[0], time.monotonic())
+            self._clients.move_to_end(key)
+
+    def _evict(self, keep):
+        """Saca por LRU los clientes que sobran, saltando los ocupados y keep."""
+        evicted = []
+        excess = len(self._clients) - self.max_size
+        if excess <= 0:
+            return evicted
+        for key in list(self._clients):
+            if excess <= 0:
+                break
+            if key == keep or self._active.get(key):
+                continue
+            evicted.append(self._clients.pop(key)[0])
+            excess -= 1
+            metrics.incr(f"{self.name}.evictions")
+        return evicted
+
+    def _expire(self, now):
+        """Saca del pool los clientes inactivos (el más antiguo va primero)."""
+        expired = []
+        for _ in range(len(self._clients)):
+            key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            if self._active.get(key):
+                # Ocupado con una llamada larga: cuenta como usado ahora
+                self._touch(key)
+                continue
+            del self._clients[key]
+            expired.append(client)
+            metrics.incr(f"{self.name}.expired")
+        return expired
+
+    def _close(self, client):
+        try:
+            if hasattr(client, "aclose"):
+                # AsyncClient: se cierra en el event loop que lo está usando
+                coro = client.aclose()
+                try:
+                    asyncio.get_running_loop().create_task(coro)
+                except RuntimeError:
+                    coro.close()
+            else:
+                client.close()
+        except Exception as e:
+            logger.warning(f"Error cerrando cliente de {self.name}: {e}")
+
+    def clear(self):
+        """Cierra y descarta todos los clientes."""
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+    async def aclear(self):
+        """Cierra y descarta todos los clientes esperando a los asíncronos."""
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            try:
+                if hasattr(client, "aclose"):
+                    await client.aclose()
+                else:
+                    client.close()
+            except Exception as e:
+                logger.warning(f"Error cerrando cliente de {self.name}: {e}")
+
+    def __len__(self):
+        return len(self._clients)
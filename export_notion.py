@@ -0,0 +1,49 @@
+import argparse
+import os
+import sys
+from notion_client import Client
+from dotenv import load_dotenv
+import config_manager
+import notion_export
+
+load_dotenv()
+
+NOTION_TOKEN = os.getenv("NOTION_INTEGRATION_TOKEN")
+
+def main():
+    parser = argparse.ArgumentParser(description="Exporta todas las tareas de una BD de Notion a CSV o JSONL.")
+    parser.add_argument("--format", choices=notion_export.FORMATS, default="csv")
+    parser.add_argument("--database", help="ID de la BD (por defecto la activa en config.json)")
+    parser.add_argument("--output", help="Fichero de salida (por defecto export_<id>.<formato>; '-' = stdout)")
+    args = parser.parse_args()
+
+    if not NOTION_TOKEN:
+        print("Error: No hay token configurado.", file=sys.stderr)
+        return 1
+
+    db_id = args.database or config_manager.get_current_database_id()
+    if not db_id:
+        print("Error: No hay base de datos configurada.", file=sys.stderr)
+        return 1
+
+    output = args.output or f"export_{db_id.replace('-', '')}.{args.format}"
+    notion = Client(auth=NOTION_TOKEN)
+
+    def progress(rows):
+        print(f"... {rows} filas", file=sys.stderr)
+
+    try:
+        if output == "-":
+            rows = notion_export.export_database_sync(notion, NOTION_TOKEN, db_id, sys.stdout, args.format, progress)
+        else:
+            with open(output, "w", encoding="utf-8", newline="") as f:
+                rows = notion_export.export_database_sync(notion, NOTION_TOKEN, db_id, f, args.format, progress)
+    except Exception as e:
+        print(f"❌ Error exportando: {e}", file=sys.stderr)
+        return 1
+
+    print(f"✅ {rows} filas exportadas a {output}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
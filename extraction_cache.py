@@ -0,0 +1,101 @@
+import copy
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import metrics
+
+# Caché de resultados de extracción de Gemini. La gente reenvía el mismo
+# texto (reintentos, tareas recurrentes) y cada vez costaba una llamada
+# completa. La clave es el texto normalizado más la versión del prompt, así
+# cambiar el prompt invalida lo guardado. Se guarda date_raw y no la fecha
+# resuelta: quien lee vuelve a pasar date_raw por date_utils, y "mañana"
+# sigue siendo mañana aunque la entrada tenga días.
+
+MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "2048"))
+MAX_BYTES = int(os.getenv("GEMINI_CACHE_MAX_BYTES", str(4 * 1024 * 1024)))
+TTL = float(os.getenv("GEMINI_CACHE_TTL", "86400"))
+
+# Coste fijo estimado por entrada (OrderedDict, tupla, dicts de la tarea)
+ENTRY_OVERHEAD = 512
+
+def normalize(text):
+    """Texto en minúsculas, NFC y con los espacios colapsados."""
+    text = unicodedata.normalize("NFC", text or "").lower()
+    return re.sub(r"\s+", " ", text).strip(" .!")
+
+def _size_of(key, value):
+    return len(key.encode()) + len(json.dumps(value, ensure_ascii=False).encode()) + ENTRY_OVERHEAD
+
+class ExtractionCache:
+    """
+    Caché LRU con TTL y tope de memoria para tareas extraídas.
+    Los valores son listas de tareas sin la clave "date" (solo date_raw).
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, ttl=TTL, name="gemini_cache"):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.name = name
+        self._entries = OrderedDict()  # clave -> (tareas, tamaño, caduca)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def key(self, kind, prompt_version, text):
+        return f"{kind}:{prompt_version}:{normalize(text)}"
+
+    def get(self, key):
+        """Copia de las tareas guardadas (sin "date"), o None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= now:
+                self._remove(key)
+                metrics.incr(f"{self.name}.expired")
+                entry = None
+            if entry is None:
+                metrics.incr(f"{self.name}.misses")
+                return None
+            self._entries.move_to_end(key)
+            metrics.incr(f"{self.name}.hits")
+            return copy.deepcopy(entry[0])
+
+    def put(self, key, tasks):
+        """Guarda las tareas quitando la fecha resuelta."""
+        value = [{k: v for k, v in task.items() if k != "date"} for task in tasks]
+        size = _size_of(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                metrics.incr(f"{self.name}.evictions")
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes}
+
+    def __len__(self):
+        return len(self._entries)
+
+_cache = ExtractionCache()
+
+def get_cache():
+    return _cache
@@ -0,0 +1,68 @@
+import mimetypes
+import os
+import pathlib
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+from google.generativeai.types import file_types
+from client_pool import ClientPool
+
+# genai.configure cambia una configuración global del proceso: con varios
+# usuarios a la vez, la petición de uno podía salir con la key de otro.
+# Aquí cada API key tiene sus propios clientes y su modelo, creados una
+# vez y reutilizados.
+#
+# google-generativeai no ofrece una API pública para un modelo con su
+# propia key: se usa client._ClientManager y se asignan model._client y
+# model._async_client. Por eso la versión está fijada en requirements.txt;
+# al subirla hay que comprobar que esos atributos siguen existiendo.
+
+MODEL_NAME = "gemini-2.5-flash-lite"
+POOL_SIZE = int(os.getenv("GEMINI_POOL_SIZE", "32"))
+IDLE_TTL = float(os.getenv("GEMINI_POOL_IDLE_TTL", "900"))
+
+class GeminiClients:
+    """Modelo y clientes de Gemini ligados a una sola API key."""
+
+    def __init__(self, auth):
+        self._manager = genai_client._ClientManager()
+        self._manager.configure(api_key=auth)
+        self.model = genai.GenerativeModel(MODEL_NAME)
+        # Sin esto el modelo tomaría los clientes globales de genai.configure
+        self.model._client = self._manager.get_default_client("generative")
+        self.model._async_client = self._manager.get_default_client("generative_async")
+
+    def upload_file(self, path, mime_type=None):
+        """Como genai.upload_file, pero con el cliente de esta key."""
+        path = pathlib.Path(path)
+        mime_type = mime_type or mimetypes.guess_type(path)[0]
+        if mime_type is None:
+            raise ValueError(f"No se pudo deducir el tipo MIME de {path}")
+        response = self._manager.get_default_client("file").create_file(
+            path=path, mime_type=mime_type, name=None, display_name=path.name, resumable=True
+        )
+        return file_types.File(response)
+
+    def close(self):
+        # Los clientes asíncronos se liberan con el recolector: su canal
+        # pertenece al event loop y aquí puede no haber uno en marcha
+        for name in ("generative", "file"):
+            client = self._manager.clients.get(name)
+            if client is not None:
+                client.transport.close()
+
+_pool = ClientPool(factory=GeminiClients, max_size=POOL_SIZE, idle_ttl=IDLE_TTL, name="gemini_pool")
+
+def get_clients(api_key):
+    """Clientes de Gemini compartidos para la API key dada."""
+    return _pool.get(api_key)
+
+def get_model(api_key):
+    """GenerativeModel de la API key dada (reutilizado entre llamadas)."""
+    return _pool.get(api_key).model
+
+def in_use(api_key):
+    """Marca los clientes de la key como ocupados (no se cierran) durante el bloque."""
+    return _pool.in_use(api_key)
+
+def close_all():
+    _pool.clear()
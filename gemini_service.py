@@ -1,58 +1,88 @@
 import os
-import google.generativeai as genai
 from dotenv import load_dotenv
 import json
 import date_utils
+import extraction_cache
+import metrics
+import task_rules
+from retry_policy import RetryPolicy
+from user_session import UserSession
 
 load_dotenv()
 
 # API key global como fallback
 DEFAULT_GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("DEFAULT_GEMINI_API_KEY")
 
-def get_chat_response(message, user_id=None):
+# Reintentos ante 429/5xx/timeouts de Gemini
+GEMINI_RETRY = RetryPolicy("gemini")
+
+# Súbela al cambiar un prompt de extracción: invalida extraction_cache
+PROMPT_VERSION = 1
+
+TRANSCRIBE_PROMPT = """Transcribe el siguiente audio a texto en español.
+Devuelve SOLO el texto transcrito, sin comentarios adicionales."""
+
+def _rules_task(text):
+    """Tarea de task_rules si es fiable (sin llamar a Gemini), o None."""
+    task = task_rules.extract_confident(text)
+    metrics.incr("gemini.rules_hits" if task else "gemini.rules_misses")
+    return task
+
+def _cache_key(kind, text):
+    return extraction_cache.get_cache().key(kind, PROMPT_VERSION, text)
+
+def _cached_tasks(key):
+    """Tareas guardadas para key con la fecha resuelta hoy, o None."""
+    tasks = extraction_cache.get_cache().get(key)
+    if tasks is None:
+        return None
+    return [_finish_task(task) for task in tasks]
+
+def _resolve_session(user_id, session):
+    """Usa la sesión del update o la resuelve (user_id None = key global)."""
+    if session is not None:
+        return session
+    return UserSession.resolve(user_id)
+
+def get_chat_response(message, user_id=None, session=None):
     """
     Genera respuesta de chat usando Gemini.
     Si user_id es None, usa la API key global.
     """
     try:
-        # Obtener API key del usuario o usar global
-        if user_id:
-            import user_config_manager
-            api_key = user_config_manager.get_user_gemini_key(user_id)
-        else:
-            api_key = DEFAULT_GEMINI_API_KEY
-        
-        if not api_key:
+        session = _resolve_session(user_id, session)
+        
+        if not session.gemini_api_key:
             return "❌ No tienes configurada tu API key de Gemini. Usa /config para configurarla."
         
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        response = model.generate_content(message)
+        model = session.gemini_model
+        response = GEMINI_RETRY.call(model.generate_content, message)
         return response.text
     except Exception as e:
         return f"Error al conectar con Gemini: {e}"
 
-def extract_task_info(text, user_id=None):
+def extract_task_info(text, user_id=None, session=None):
     """
     Usa Gemini para extraer información estructurada de una tarea.
     Retorna un diccionario con: title, description, date, status, type_val.
     """
+    task = _rules_task(text)
+    if task:
+        return task
+    key = _cache_key("task", text)
+    cached = _cached_tasks(key)
+    if cached:
+        return cached[0]
     try:
         print(f"DEBUG: Enviando a Gemini: {text}")
         
-        # Obtener API key del usuario o usar global
-        if user_id:
-            import user_config_manager
-            api_key = user_config_manager.get_user_gemini_key(user_id)
-        else:
-            api_key = DEFAULT_GEMINI_API_KEY
+        session = _resolve_session(user_id, session)
         
-        if not api_key:
+        if not session.gemini_api_key:
             print("❌ No hay API key de Gemini configurada")
-            return {"title": text, "description": None, "date": None, "status": None, "type_val": None}
+            return _fallback_task(text)
         
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
+        model = session.gemini_model
         
         prompt = f"""
         Analiza el siguiente texto y extrae la información para crear una tarea en Notion.
@@ -74,28 +104,65 @@ def extract_task_info(text, user_id=None):
             "type_val": "Personal"
         }}
         """
-        response = model.generate_content(prompt)
+        response = GEMINI_RETRY.call(model.generate_content, prompt)
         print(f"DEBUG: Respuesta cruda de Gemini: {response.text}")
         
-        # Clean response to ensure it's just JSON
-        clean_text = response.text.replace("```json", "").replace("```", "").strip()
-        task_data = json.loads(clean_text)
-        
-        # Parsear fecha con date_utils
-        date_raw = task_data.get("date_raw")
-        if date_raw:
-            parsed_date = date_utils.parse_spanish_date(date_raw)
-            task_data["date"] = parsed_date
-        else:
-            task_data["date"] = None
-            
-        return task_data
+        task = _finish_task(_parse_json(response.text))
+        extraction_cache.get_cache().put(key, [task])
+        return task
         
     except Exception as e:
         print(f"❌ Error extrayendo info con Gemini: {e}")
-        return {"title": text, "description": None, "date": None, "status": None, "type_val": None}
+        return _fallback_task(text)
+
+def _fallback_task(text):
+    return {"title": text, "description": None, "date": None, "status": None, "type_val": None}
+
+def _parse_json(text):
+    # Clean response to ensure it's just JSON
+    clean_text = text.replace("```json", "").replace("```", "").strip()
+    return json.loads(clean_text)
 
-def transcribe_audio(audio_file_path, user_id=None):
+def _finish_task(task_data):
+    """Completa una tarea extraída: parsea date_raw con date_utils."""
+    date_raw = task_data.get("date_raw")
+    if date_raw:
+        task_data["date"] = date_utils.parse_spanish_date(date_raw)
+    else:
+        task_data["date"] = None
+    return task_data
+
+def _tasks_prompt(text):
+    """Prompt de async_gemini_service.extract_tasks (también lo usa bench_rules)."""
+    return f"""
+    Analiza el siguiente texto y extrae las tareas para crear en Notion.
+    El texto puede contener una sola tarea o una lista de varias.
+    El texto es: "{text}"
+    
+    Devuelve SOLO un JSON válido: una lista con un objeto por tarea, cada
+    uno con las siguientes claves (si no encuentras algo, usa null):
+    - title: El título principal de la tarea.
+    - description: Detalles adicionales.
+    - date_raw: Expresión de fecha tal como aparece (ej: "mañana", "próximo lunes", "2025-12-25").
+      Si una fecha se dice una vez para varias tareas, aplícala solo a las que se refiere.
+    - status: El estado (ej: "En progreso", "Por hacer", "Completado"). Si no se menciona, usa "Por hacer".
+    - type_val: El tipo de proyecto (ej: "Personal", "Negocio").
+    
+    Ejemplo para "comprar leche y reservar vuelo para el viernes":
+    [
+        {{"title": "Comprar leche", "description": null, "date_raw": null, "status": "Por hacer", "type_val": "Personal"}},
+        {{"title": "Reservar vuelo", "description": null, "date_raw": "viernes", "status": "Por hacer", "type_val": "Personal"}}
+    ]
+    """
+
+def _parse_tasks(response_text):
+    """Lista de tareas de la respuesta de Gemini (vacía si no trae ninguna)."""
+    data = _parse_json(response_text)
+    if isinstance(data, dict):
+        data = data.get("tasks", [data])
+    return [_finish_task(task) for task in data if isinstance(task, dict) and task.get("title")]
+
+def transcribe_audio(audio_file_path, user_id=None, session=None):
     """
     Transcribe un archivo de audio usando Gemini.
     Soporta archivos de voz de Telegram (.ogg).
@@ -103,30 +170,20 @@ def transcribe_audio(audio_file_path, user_id=None):
     try:
         print(f"DEBUG: Transcribiendo audio: {audio_file_path}")
         
-        # Obtener API key del usuario o usar global
-        if user_id:
-            import user_config_manager
-            api_key = user_config_manager.get_user_gemini_key(user_id)
-        else:
-            api_key = DEFAULT_GEMINI_API_KEY
+        session = _resolve_session(user_id, session)
         
-        if not api_key:
+        if not session.gemini_api_key:
             print("❌ No hay API key de Gemini configurada")
             return None
         
-        genai.configure(api_key=api_key)
+        # Modelo y clientes ligados a la key de la sesión
+        model = session.gemini_model
         
         # Upload del archivo a Gemini
-        audio_file = genai.upload_file(path=audio_file_path)
+        audio_file = GEMINI_RETRY.call(session.gemini_clients.upload_file, audio_file_path)
         print(f"DEBUG: Archivo subido: {audio_file.uri}")
         
-        # Usar modelo con soporte de audio
-        model = genai.GenerativeModel('gemini-2.5-flash-lite')
-        
-        prompt = """Transcribe el siguiente audio a texto en español.
-        Devuelve SOLO el texto transcrito, sin comentarios adicionales."""
-        
-        response = model.generate_content([prompt, audio_file])
+        response = GEMINI_RETRY.call(model.generate_content, [TRANSCRIBE_PROMPT, audio_file])
         
         print(f"DEBUG: Transcripción: {response.text}")
         
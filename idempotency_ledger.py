@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Registro de las páginas ya creadas por cada clave de idempotencia, para
+# que reintentos y updates de Telegram reentregados no dupliquen tareas.
+
+LEDGER_DB = os.getenv("NOTION_LEDGER_DB", "notion_ledger.db")
+# Claves derivadas de un update de Telegram: se recuerdan una semana
+LEDGER_TTL = float(os.getenv("NOTION_LEDGER_TTL", str(7 * 86400)))
+# Claves por contenido: solo protegen de repeticiones cercanas, porque
+# crear dos veces la misma tarea días después puede ser intencionado
+CONTENT_TTL = float(os.getenv("NOTION_LEDGER_CONTENT_TTL", "600"))
+# Cada cuántos registros se borran las claves caducadas
+PURGE_EVERY = 500
+
+def content_key(user_id, database_id, fields):
+    """Clave por contenido para creaciones que no vienen de un update concreto."""
+    data = json.dumps([str(user_id), database_id, fields], sort_keys=True, ensure_ascii=False)
+    return "content:" + hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class IdempotencyLedger:
+    """
+    Tabla clave → página creada (id y url), con caducidad por entrada.
+    Los registros son pequeños: una fila por tarea creada desde el bot.
+    """
+
+    def __init__(self, path=LEDGER_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS created_pages (
+                idem_key TEXT PRIMARY KEY,
+                user_id TEXT,
+                page_id TEXT NOT NULL,
+                url TEXT,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS created_pages_by_page ON created_pages (page_id)")
+        self.purge()
+
+    def get(self, key):
+        """Página ya creada con esta clave ({"id", "url"}) o None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT page_id, url FROM created_pages WHERE idem_key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        if row:
+            metrics.incr("notion_ledger.hits")
+            return {"id": row[0], "url": row[1]}
+        metrics.incr("notion_ledger.misses")
+        return None
+
+    def has_page(self, page_id):
+        """True si la página ya está apuntada para alguna clave."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM created_pages WHERE page_id = ? AND expires_at > ? LIMIT 1",
+                (page_id, time.time())
+            ).fetchone()
+        return row is not None
+
+    def record(self, key, user_id, page_id, url, ttl=None):
+        """Apunta la página creada para la clave."""
+        if ttl is None:
+            ttl = CONTENT_TTL if key.startswith("content:") else LEDGER_TTL
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO created_pages (idem_key, user_id, page_id, url, created_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, None if user_id is None else str(user_id), page_id, url, now, now + ttl)
+            )
+            self._records += 1
+            purge = self._records % PURGE_EVERY == 0
+        if purge:
+            self.purge()
+
+    def purge(self):
+        """Borra las claves caducadas."""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM created_pages WHERE expires_at <= ?", (time.time(),))
+        if cursor.rowcount:
+            logger.info(f"Ledger: {cursor.rowcount} clave(s) caducada(s) borrada(s)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+def get_ledger():
+    """Ledger compartido del proceso."""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = IdempotencyLedger(LEDGER_DB)
+    return _ledger
@@ -1,11 +1,23 @@
 import os
 import logging
+import tempfile
+import time
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-import gemini_service
-import notion_service
+import async_gemini_service
+import extraction_cache
+import async_notion_service
 import user_config_manager
+import metrics
+import notion_export
+import notion_mirror
+import notion_outbox
+import gemini_pool
+import notion_pool
+import rate_limiter
+import telegram_stream
+from user_session import UserSession
 
 load_dotenv()
 
@@ -21,6 +33,23 @@ logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# IDs de Telegram (separados por comas) que pueden ver /stats
+ADMIN_USER_IDS = {
+    int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip().isdigit()
+}
+
+# Updates atendidos a la vez; con 1 una llamada lenta a Gemini haría
+# esperar a todos los demás usuarios (y a su propio /cancelar)
+CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+
+CANCELLED_TEXT = "🛑 Cancelado."
+
+# Respuestas del chat en streaming (editando el mensaje según llega el texto)
+STREAM_CHAT = os.getenv("GEMINI_STREAM_CHAT", "1") == "1"
+
+# Segundos mínimos entre ediciones del mensaje de progreso de /exportar
+EXPORT_PROGRESS_INTERVAL = 3.0
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     has_config = user_config_manager.has_user_config(user_id)
@@ -45,7 +74,11 @@ Para empezar, configura tus credenciales:
 
 🔍 **Buscar y Editar:**
 • `/buscar <término>` - Busca tareas
+• `/buscar_todas <término>` - Busca en todas tus BDs
+• `/tareas` - Últimas tareas
+• `/exportar [csv|jsonl]` - Exporta todas tus tareas
 • `/editar <ID> <cambios>` - Edita tarea
+• `/cancelar` - Cancela lo que esté procesando
 
 💬 **Conversar:**
 • Envía cualquier mensaje
@@ -96,6 +129,7 @@ async def config(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • `/add_db <alias> <id>` - Añade BD
 • `/setup_notion` - 📖 Guía paso a paso
 • `/list_dbs` - Ver tus BDs
+• `/refresh_schema` - Releer columnas de la BD
 • `/reset_config` - Borrar configuración
 
 💡 Tus credenciales son **privadas**.
@@ -208,6 +242,11 @@ Usa `/config` para más detalles
 Ejemplo:
 `/plan Reunión mañana tipo:Negocio`
 
+Campos opcionales: `tipo:` `estado:` `fecha:` `desc:"..."`
+
+Varias a la vez:
+`/plan Comprar leche, llamar al banco y reservar vuelo el viernes`
+
 **Voz 🎙️:**
 Presiona micrófono y di la tarea
 """,
@@ -218,6 +257,12 @@ Presiona micrófono y di la tarea
 Ejemplo:
 `/buscar reunión`
 
+Con `~` delante tolera erratas:
+`/buscar ~reunoin`
+
+En todas tus BDs a la vez:
+`/buscar_todas reunión`
+
 Muestra título, link e ID
 """,
         'help_edit': """✏️ **Editar**
@@ -242,6 +287,10 @@ async def back_to_menu_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     await start(update, context)
 
+def _idem_key(update):
+    """Clave de idempotencia del update: la misma si Telegram lo reentrega."""
+    return f"{update.effective_user.id}:{update.update_id}"
+
 async def plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text_to_plan = ' '.join(context.args)
@@ -252,27 +301,48 @@ async def plan(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="Ejemplo: /plan Comprar leche mañana"
         )
         return
+    
+    if notion_outbox.is_enqueued(_idem_key(update)):
+        # Update reentregado: su mensaje "en cola" ya existe y se editará
+        return
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="🧠 Analizando..."
     )
 
-    task_info = gemini_service.extract_task_info(text_to_plan, user_id)
-    result = notion_service.create_page(
-        title=task_info.get("title"),
-        user_id=user_id,
-        description=task_info.get("description"),
-        date=task_info.get("date"),
-        status=task_info.get("status"),
-        type_val=task_info.get("type_val")
-    )
+    session = UserSession.resolve(user_id)
+    error = async_notion_service.check_session(session)
+    if error:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=error)
+        return
     
-    await context.bot.send_message(
+    try:
+        tasks = await async_gemini_service.extract_tasks(text_to_plan, session=session)
+    except async_gemini_service.GeminiCancelled:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=CANCELLED_TEXT)
+        return
+    if notion_outbox.is_enqueued(_idem_key(update)):
+        # La otra entrega del mismo update se adelantó mientras Gemini respondía
+        return
+    ack = await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=result
+        text=_queued_text(tasks)
+    )
+    # Se guarda en el outbox; el worker edita este mensaje con el resultado
+    notion_outbox.enqueue_creates(
+        session, tasks,
+        idem_key=_idem_key(update),
+        chat_id=ack.chat_id,
+        message_id=ack.message_id
     )
 
+def _queued_text(tasks):
+    if len(tasks) == 1:
+        return f"⏳ En cola: {tasks[0].get('title')}\nTe confirmo aquí cuando esté en Notion."
+    titles = "\n".join(f"• {task.get('title')}" for task in tasks)
+    return f"⏳ {len(tasks)} tareas en cola:\n{titles}\nTe confirmo aquí cuando estén en Notion."
+
 async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     query = ' '.join(context.args)
@@ -284,12 +354,22 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
+    session = UserSession.resolve(user_id)
+    error = async_notion_service.check_session(session)
+    if error:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=error)
+        return
+    
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text=f"🔍 Buscando '{query}'..."
     )
     
-    results = notion_service.search_pages(query, limit=10)
+    # "~" delante fuerza la búsqueda aproximada (tolerante a erratas)
+    fuzzy = query.startswith('~')
+    query = query.lstrip('~').strip()
+    
+    results = await async_notion_service.search_pages(query, limit=10, session=session, fuzzy=fuzzy)
     
     if not results:
         await context.bot.send_message(
@@ -298,7 +378,10 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    msg = f"📋 Encontré {len(results)} tarea(s):\n\n"
+    if 'similarity' in results[0]:
+        msg = f"🔎 {len(results)} tarea(s) con título parecido:\n\n"
+    else:
+        msg = f"📋 Encontré {len(results)} tarea(s):\n\n"
     for i, task in enumerate(results, 1):
         msg += f"{i}. {task['title']}\n"
         msg += f"   🔗 {task['url']}\n"
@@ -310,7 +393,75 @@ async def buscar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode='Markdown'
     )
 
+async def buscar_todas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Busca en todas las BDs del usuario a la vez."""
+    user_id = update.effective_user.id
+    query = ' '.join(context.args)
+    
+    if not query:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Uso: /buscar_todas <término>"
+        )
+        return
+    
+    fuzzy = query.startswith('~')
+    query = query.lstrip('~').strip()
+    
+    session = UserSession.resolve(user_id)
+    if not session.databases:
+        await update.message.reply_text("No tienes bases de datos configuradas. Usa /add_db")
+        return
+    
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"🔍 Buscando '{query}' en {len(session.databases)} BD(s)..."
+    )
+    
+    results, failed = await async_notion_service.search_all_databases(
+        query, session, limit=10, fuzzy=fuzzy
+    )
+    
+    if not results:
+        msg = f"No encontré tareas con '{query}' en ninguna BD"
+    else:
+        msg = f"📋 Encontré {len(results)} tarea(s):\n\n"
+        for i, task in enumerate(results, 1):
+            msg += f"{i}. [{task['alias']}] {task['title']}\n"
+            msg += f"   🔗 {task['url']}\n"
+            msg += f"   ID: `{task['id']}`\n\n"
+    if failed:
+        msg += f"\n⚠️ Sin respuesta a tiempo de: {', '.join(failed)}"
+    
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=msg,
+        parse_mode='Markdown'
+    )
+
+async def tareas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lista las últimas tareas editadas de la BD activa."""
+    session = UserSession.resolve(update.effective_user.id)
+    error = async_notion_service.check_session(session)
+    if error:
+        await update.message.reply_text(error)
+        return
+    results = await async_notion_service.list_pages(session, limit=10)
+    
+    if not results:
+        await update.message.reply_text("No hay tareas en tu base de datos activa.")
+        return
+    
+    msg = "🗂️ Últimas tareas:\n\n"
+    for i, task in enumerate(results, 1):
+        msg += f"{i}. {task['title']}\n"
+        msg += f"   ID: `{task['id']}`\n"
+    
+    await update.message.reply_text(msg, parse_mode='Markdown')
+
 async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    
     if len(context.args) < 2:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -352,10 +503,30 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    result = notion_service.update_page(page_id, **updates)
-    await context.bot.send_message(
+    session = UserSession.resolve(user_id)
+    
+    # Comprobar el ID en el espejo local antes de gastar una escritura
+    page = await async_notion_service.get_page(session, page_id)
+    if not page:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"❌ No encuentro la tarea con ID {page_id}. Usa /buscar para ver los IDs."
+        )
+        return
+    
+    if notion_outbox.is_enqueued(_idem_key(update)):
+        # Update reentregado: su mensaje "en cola" ya existe y se editará
+        return
+    
+    ack = await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=result
+        text="⏳ Edición en cola. Te confirmo aquí cuando esté en Notion."
+    )
+    notion_outbox.enqueue_update(
+        session, page_id, updates,
+        idem_key=_idem_key(update),
+        chat_id=ack.chat_id,
+        message_id=ack.message_id
     )
 
 async def add_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -506,12 +677,15 @@ Ahora puedes:
 → Verifica que copiaste el ID completo
 
 ❌ "Property not found"
-→ Tu BD necesita estas columnas:
-  • Name (título)
-  • descripcion (texto)
-  • Fecha de Inicio (fecha)
-  • Estado del Proyecto (select)
-  • Tipo (texto)
+→ No hace falta una plantilla fija: el bot busca en tu BD
+  cada columna por su tipo y su nombre:
+  • Título: la columna de título
+  • Descripción: texto ("descripción", "notas"...)
+  • Fecha: fecha ("fecha", "inicio", "plazo"...)
+  • Estado: status o select ("estado")
+  • Tipo: select o texto ("tipo", "categoría"...)
+  Las que no encuentre se omiten. Usa `/refresh_schema`
+  para ver qué columna usa para cada campo.
 """
     
     await update.message.reply_text(guide, parse_mode='Markdown')
@@ -567,12 +741,19 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         action="typing"
     )
     
+    reply = telegram_stream.StreamingMessage(context.bot, update.effective_chat.id)
     try:
-        response = gemini_service.get_chat_response(user_text, user_id)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=response
-        )
+        session = UserSession.resolve(user_id)
+        if STREAM_CHAT:
+            response = await async_gemini_service.stream_chat_response(user_text, reply.update, session=session)
+        else:
+            response = await async_gemini_service.get_chat_response(user_text, session=session)
+        await reply.finish(response)
+    except async_gemini_service.GeminiCancelled:
+        if reply.text:
+            await reply.finish(f"{reply.text}\n\n{CANCELLED_TEXT}")
+        else:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=CANCELLED_TEXT)
     except Exception as e:
         logger.error(f"Error en chat: {e}", exc_info=True)
         await context.bot.send_message(
@@ -582,6 +763,9 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
+    if notion_outbox.is_enqueued(_idem_key(update)):
+        # Update reentregado: su mensaje "en cola" ya existe y se editará
+        return
     await update.message.reply_text("🎙️ Procesando...")
     
     voice_file_path = None
@@ -590,30 +774,33 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         voice_file_path = f"voice_{update.message.voice.file_unique_id}.ogg"
         await voice_file.download_to_drive(voice_file_path)
         
-        transcription = gemini_service.transcribe_audio(voice_file_path, user_id)
+        session = UserSession.resolve(user_id)
+        transcription = await async_gemini_service.transcribe_audio(voice_file_path, session=session)
         
         if not transcription:
             await update.message.reply_text("❌ Error transcribiendo")
             return
         
-        task_info = gemini_service.extract_task_info(transcription, user_id)
-        
-        result = notion_service.create_page(
-            title=task_info.get("title"),
-            user_id=user_id,
-            description=task_info.get("description"),
-            date=task_info.get("date"),
-            status=task_info.get("status"),
-            type_val=task_info.get("type_val")
-        )
+        error = async_notion_service.check_session(session)
+        if error:
+            await update.message.reply_text(error)
+            return
         
-        await update.message.reply_text(
-            f"✅ Tarea creada\n\n"
-            f"📝 *Transcripción:* _{transcription}_\n\n"
-            f"{result}",
-            parse_mode='Markdown'
+        tasks = await async_gemini_service.extract_tasks(transcription, session=session)
+        if notion_outbox.is_enqueued(_idem_key(update)):
+            return
+        header = f"📝 Transcripción: {transcription}\n\n"
+        ack = await update.message.reply_text(header + _queued_text(tasks))
+        notion_outbox.enqueue_creates(
+            session, tasks,
+            idem_key=_idem_key(update),
+            chat_id=ack.chat_id,
+            message_id=ack.message_id,
+            header=header
         )
         
+    except async_gemini_service.GeminiCancelled:
+        await update.message.reply_text(CANCELLED_TEXT)
     except Exception as e:
         logging.error(f"Error en voz: {e}", exc_info=True)
         await update.message.reply_text("❌ Error procesando voz")
@@ -621,12 +808,117 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if voice_file_path and os.path.exists(voice_file_path):
             os.remove(voice_file_path)
 
+async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancela las llamadas a Gemini que el usuario tenga en curso."""
+    cancelled = async_gemini_service.cancel_user(update.effective_user.id)
+    if not cancelled:
+        await update.message.reply_text("No hay nada en curso que cancelar.")
+    # Si había algo, el handler cancelado ya responde con CANCELLED_TEXT
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Exporta todas las tareas de la BD activa y las envía como documento."""
+    fmt = (context.args[0].lower() if context.args else "csv")
+    if fmt not in notion_export.FORMATS:
+        await update.message.reply_text("Uso: /exportar [csv|jsonl]")
+        return
+    
+    session = UserSession.resolve(update.effective_user.id)
+    error = async_notion_service.check_session(session)
+    if error:
+        await update.message.reply_text(error)
+        return
+    
+    status = await update.message.reply_text("📦 Exportando tareas...")
+    last_edit = time.monotonic()
+    
+    async def progress(rows):
+        # Editar como mucho cada pocos segundos para no chocar con los límites de Telegram
+        nonlocal last_edit
+        if time.monotonic() - last_edit < EXPORT_PROGRESS_INTERVAL:
+            return
+        last_edit = time.monotonic()
+        try:
+            await status.edit_text(f"📦 Exportando tareas... {rows} hasta ahora")
+        except Exception as e:
+            logger.warning(f"No se pudo actualizar el progreso del export: {e}")
+    
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            rows = await notion_export.export_database(session, session.database_id, f, fmt, progress)
+        filename = f"tareas_{session.db_alias or 'notion'}.{fmt}"
+        with open(path, "rb") as f:
+            await update.message.reply_document(document=f, filename=filename)
+        await status.edit_text(f"✅ {rows} tarea(s) exportada(s)")
+    except Exception as e:
+        logger.error(f"Error exportando: {e}", exc_info=True)
+        await status.edit_text("❌ Error exportando la base de datos.")
+    finally:
+        os.remove(path)
+
+async def refresh_schema(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Vuelve a leer de Notion el esquema de la BD activa."""
+    session = UserSession.resolve(update.effective_user.id)
+    
+    error = async_notion_service.check_session(session)
+    if error:
+        await update.message.reply_text(error)
+        return
+    
+    try:
+        schema = await async_notion_service.get_schema(session, refresh=True)
+    except Exception as e:
+        logger.error(f"Error refrescando esquema: {e}", exc_info=True)
+        await update.message.reply_text("❌ No pude leer el esquema de la base de datos.")
+        return
+    
+    msg = "🔄 Esquema actualizado:\n\n"
+    for name, prop in schema.properties.items():
+        msg += f"• {name} ({prop['type']})\n"
+    msg += "\n🧭 Columnas que usa el bot:\n"
+    for role, (name, prop_type) in schema.roles.items():
+        msg += f"• {role} → {name}\n"
+    await update.message.reply_text(msg)
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra los contadores internos del bot (pool de clientes, cachés...). Solo admins."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ Solo los administradores del bot pueden ver /stats.")
+        return
+    metrics.set_gauge("notion_rate.queue_depth_now", rate_limiter.total_queue_depth())
+    metrics.set_gauge("notion_outbox.pending", notion_outbox.get_outbox().pending_count())
+    metrics.set_gauge("gemini.inflight", async_gemini_service.inflight_count())
+    cache = extraction_cache.get_cache().stats()
+    metrics.set_gauge("gemini_cache.entries", cache["entries"])
+    metrics.set_gauge("gemini_cache.kb", round(cache["bytes"] / 1024, 1))
+    mirror = notion_mirror.get_mirror()
+    if mirror:
+        memory = mirror.index_memory()
+        metrics.set_gauge("notion_mirror.trigram_titles", memory["docs"])
+        metrics.set_gauge("notion_mirror.trigram_kb", round(memory["bytes"] / 1024, 1))
+        metrics.set_gauge("notion_mirror.trigram_bytes_per_title", round(memory["bytes_per_title"]))
+    await update.message.reply_text(f"📈 Métricas\n\n{metrics.format_report()}")
+
+async def on_startup(application):
+    """Arranca el worker del outbox (retoma lo que quedó pendiente)."""
+    async def notify(chat_id, message_id, text):
+        await application.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+    notion_outbox.start(notify)
+
+async def on_shutdown(application):
+    """Vuelca a disco la configuración pendiente antes de salir."""
+    async_gemini_service.cancel_all()
+    await notion_outbox.stop()
+    user_config_manager.shutdown()
+    await notion_pool.aclose_all()
+    gemini_pool.close_all()
+
 if __name__ == '__main__':
     
     if not TELEGRAM_BOT_TOKEN:
         print("❌ Error: TELEGRAM_BOT_TOKEN no encontrado")
     else:
-        application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+        application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown).concurrent_updates(CONCURRENT_UPDATES).build()
         
         # Comandos
         application.add_handler(CommandHandler('start', start))
@@ -638,10 +930,16 @@ if __name__ == '__main__':
         application.add_handler(CommandHandler('reset_config', reset_config))
         application.add_handler(CommandHandler('plan', plan))
         application.add_handler(CommandHandler('buscar', buscar))
+        application.add_handler(CommandHandler('buscar_todas', buscar_todas))
+        application.add_handler(CommandHandler('tareas', tareas))
         application.add_handler(CommandHandler('editar', editar))
         application.add_handler(CommandHandler('add_db', add_db))
         application.add_handler(CommandHandler('set_db', set_db))
         application.add_handler(CommandHandler('list_dbs', list_dbs))
+        application.add_handler(CommandHandler('refresh_schema', refresh_schema))
+        application.add_handler(CommandHandler('stats', stats))
+        application.add_handler(CommandHandler('exportar', exportar))
+        application.add_handler(CommandHandler('cancelar', cancelar))
         
         # Botones
         application.add_handler(CallbackQueryHandler(button_callback, pattern='^help_'))
@@ -0,0 +1,59 @@
+import threading
+from collections import defaultdict
+
+# Contadores del proceso (aciertos de caché, reintentos, etc.)
+_counters = defaultdict(int)
+# Resúmenes de valores observados (tiempos de espera, tamaños...): count/sum/max
+_summaries = {}
+# Valores instantáneos (profundidad de colas, elementos en caché...)
+_gauges = {}
+_lock = threading.Lock()
+
+def incr(name, value=1):
+    """Suma value al contador name."""
+    with _lock:
+        _counters[name] += value
+
+def get(name):
+    """Devuelve el valor actual de un contador."""
+    with _lock:
+        return _counters.get(name, 0)
+
+def observe(name, value):
+    """Registra un valor observado en el resumen name."""
+    with _lock:
+        summary = _summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        summary["count"] += 1
+        summary["sum"] += value
+        summary["max"] = max(summary["max"], value)
+
+def set_gauge(name, value):
+    """Fija el valor instantáneo de name."""
+    with _lock:
+        _gauges[name] = value
+
+def snapshot():
+    """Devuelve una copia de todos los contadores."""
+    with _lock:
+        return dict(_counters)
+
+def summaries():
+    """Devuelve una copia de los resúmenes (count/sum/max por nombre)."""
+    with _lock:
+        return {name: dict(summary) for name, summary in _summaries.items()}
+
+def gauges():
+    """Devuelve una copia de los valores instantáneos."""
+    with _lock:
+        return dict(_gauges)
+
+def format_report():
+    """Texto legible con todas las métricas, ordenadas por nombre."""
+    lines = [f"{name}: {value}" for name, value in sorted(snapshot().items())]
+    lines += [f"{name}: {value}" for name, value in sorted(gauges().items())]
+    for name, summary in sorted(summaries().items()):
+        avg = summary["sum"] / summary["count"] if summary["count"] else 0
+        lines.append(f"{name}: n={summary['count']} avg={avg:.1f} max={summary['max']:.1f}")
+    if not lines:
+        return "Sin métricas todavía."
+    return "\n".join(lines)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Script de migración para importar users_config.json al backend SQLite
+Ejecutar UNA VEZ y después arrancar el bot con USER_CONFIG_BACKEND=sqlite
+"""
+
+import os
+import user_config_store
+
+def migrate():
+    print("🔄 Iniciando migración de users_config.json a SQLite...")
+    
+    json_path = user_config_store.JSON_CONFIG_FILE
+    db_path = os.getenv("USER_CONFIG_DB", user_config_store.SQLITE_CONFIG_FILE)
+    
+    json_store = user_config_store.JsonUserConfigStore(json_path)
+    if not os.path.exists(json_path) and not os.path.exists(json_store.journal_path):
+        print(f"❌ No se encontró {json_path}, no hay nada que migrar")
+        return
+    
+    # Verificar si ya existe la base de datos
+    if os.path.exists(db_path):
+        response = input(f"⚠️  {db_path} ya existe. ¿Importar encima? (s/N): ")
+        if response.lower() != 's':
+            print("❌ Migración cancelada")
+            return
+    
+    # Se lee con el backend JSON para incluir los cambios que siguen en
+    # el journal; al cerrarlo quedan también volcados en el archivo
+    try:
+        users_config = json_store.load_all()
+    finally:
+        json_store.close()
+    if not users_config:
+        print(f"❌ No se pudo leer ningún usuario de {json_path}")
+        return
+    
+    print(f"✅ Leído {json_path}: {len(users_config)} usuario(s)")
+    
+    store = user_config_store.SqliteUserConfigStore(db_path)
+    try:
+        imported = store.import_config(users_config)
+        num_dbs = sum(len(cfg.get("notion_databases", {})) for cfg in users_config.values())
+    finally:
+        store.close()
+    
+    print("✅ Migración completada exitosamente")
+    print(f"📄 Creado: {db_path} ({imported} usuario(s), {num_dbs} BD(s))")
+    
+    print("\n📝 Próximos pasos:")
+    print("1. Añade USER_CONFIG_BACKEND=sqlite a tu .env")
+    print(f"2. Conserva {json_path} como backup")
+    print("3. Reinicia el bot")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,125 @@
+import csv
+import json
+import logging
+import metrics
+from notion_mirror import _plain_value
+from notion_service import _anotion_call, _notion_call
+
+logger = logging.getLogger(__name__)
+
+# Exportación completa de una BD de Notion a CSV o JSONL. Se sigue el
+# cursor de databases.query y cada lote de 100 páginas se escribe y se
+# descarta, así la memoria no depende del tamaño de la BD.
+
+FORMATS = ("csv", "jsonl")
+PAGE_SIZE = 100
+# Campos de la página que van antes de las propiedades de la BD, con el
+# nombre de su columna: llevan "_" delante para no chocar con propiedades
+# que se llamen igual ("url" es un nombre de propiedad habitual)
+META_COLUMNS = {
+    "id": "_id",
+    "url": "_url",
+    "created_time": "_created_time",
+    "last_edited_time": "_last_edited_time",
+}
+
+def property_columns(db):
+    """Propiedad -> columna del export; si aun así choca con un metadato, se le añade sufijo."""
+    reserved = set(META_COLUMNS.values())
+    columns = {}
+    for name in db.get("properties", {}):
+        column = name
+        while column in reserved:
+            column += " (propiedad)"
+        reserved.add(column)
+        columns[name] = column
+    return columns
+
+def columns_for(db):
+    """Cabecera del export: metadatos y luego las propiedades de la BD."""
+    return list(META_COLUMNS.values()) + list(property_columns(db).values())
+
+def page_row(page, columns=None):
+    """
+    Fila de una página: metadatos y el valor en texto de cada propiedad.
+    columns es el resultado de property_columns (por defecto, el nombre tal cual).
+    """
+    row = {column: page.get(field) for field, column in META_COLUMNS.items()}
+    for name, prop in page.get("properties", {}).items():
+        column = columns.get(name, name) if columns else name
+        if column in row:
+            continue
+        row[column] = _plain_value(prop)
+    return row
+
+class ExportWriter:
+    """Escribe filas en CSV (cabecera fija) o JSONL sobre un fichero de texto abierto."""
+
+    def __init__(self, out, fmt, db):
+        if fmt not in FORMATS:
+            raise ValueError(f"Formato no soportado: {fmt} (usa {', '.join(FORMATS)})")
+        self.fmt = fmt
+        self.out = out
+        self.count = 0
+        self.columns = property_columns(db)
+        if fmt == "csv":
+            self._csv = csv.DictWriter(out, fieldnames=columns_for(db), extrasaction="ignore")
+            self._csv.writeheader()
+
+    def write_pages(self, pages):
+        for page in pages:
+            row = page_row(page, self.columns)
+            if self.fmt == "csv":
+                self._csv.writerow(row)
+            else:
+                self.out.write(json.dumps(row, ensure_ascii=False) + "\n")
+            self.count += 1
+        metrics.incr("notion_export.rows", len(pages))
+
+def _query_kwargs(database_id, cursor):
+    kwargs = {"database_id": database_id, "page_size": PAGE_SIZE}
+    if cursor:
+        kwargs["start_cursor"] = cursor
+    return kwargs
+
+async def export_database(session, database_id, out, fmt="csv", progress=None):
+    """
+    Exporta todas las páginas de la BD a out (fichero de texto abierto).
+    progress(filas) es una corutina opcional que se llama tras cada lote.
+    Retorna el número de filas escritas.
+    """
+    db = await _anotion_call(
+        session.notion_token, session.notion_async_client.databases.retrieve, database_id=database_id
+    )
+    writer = ExportWriter(out, fmt, db)
+    cursor = None
+    while True:
+        # Cliente vivo en cada lote: la exportación puede durar más que el TTL del pool
+        response = await _anotion_call(
+            session.notion_token, session.notion_async_client.databases.query,
+            **_query_kwargs(database_id, cursor)
+        )
+        writer.write_pages(response.get("results", []))
+        if progress:
+            await progress(writer.count)
+        cursor = response.get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            break
+    metrics.incr("notion_export.exports")
+    logger.info(f"Export de {database_id}: {writer.count} fila(s) en {fmt}")
+    return writer.count
+
+def export_database_sync(client, token, database_id, out, fmt="csv", progress=None):
+    """Versión síncrona de export_database (para scripts); progress es una función normal."""
+    db = _notion_call(token, client.databases.retrieve, database_id=database_id)
+    writer = ExportWriter(out, fmt, db)
+    cursor = None
+    while True:
+        response = _notion_call(token, client.databases.query, **_query_kwargs(database_id, cursor))
+        writer.write_pages(response.get("results", []))
+        if progress:
+            progress(writer.count)
+        cursor = response.get("next_cursor")
+        if not response.get("has_more") or not cursor:
+            break
+    return writer.count
@@ -0,0 +1,386 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+import metrics
+import notion_schema
+import search_index
+
+logger = logging.getLogger(__name__)
+
+MIRROR_DB = os.getenv("NOTION_MIRROR_DB", "notion_mirror.db")
+MIRROR_ENABLED = os.getenv("NOTION_MIRROR_ENABLED", "1") != "0"
+# Cada cuánto se piden a Notion los cambios recientes (sync incremental)
+SYNC_INTERVAL = float(os.getenv("NOTION_MIRROR_SYNC_INTERVAL", "60"))
+# Cada cuánto se recorre la BD completa para detectar páginas borradas
+FULL_SYNC_INTERVAL = float(os.getenv("NOTION_MIRROR_FULL_SYNC_INTERVAL", "86400"))
+
+def normalize_id(notion_id):
+    """IDs de Notion sin guiones, para comparar los de la URL con los de la API."""
+    return (notion_id or "").replace("-", "").lower()
+
+def _plain_value(prop):
+    """Valor de una propiedad de Notion como texto (None si está vacía)."""
+    prop_type = prop.get("type")
+    value = prop.get(prop_type)
+    if prop_type in ("title", "rich_text"):
+        return "".join(part.get("plain_text", "") for part in value or []) or None
+    if prop_type in ("select", "status"):
+        return value.get("name") if value else None
+    if prop_type == "multi_select":
+        return ", ".join(opt.get("name", "") for opt in value or []) or None
+    if prop_type == "date":
+        return value.get("start") if value else None
+    if prop_type in ("number", "checkbox", "url", "email", "phone_number",
+                     "string", "boolean", "created_time", "last_edited_time"):
+        return None if value is None else str(value)
+    if prop_type == "formula":
+        # {"type": "string" | "number" | "boolean" | "date", ...}: misma forma que una propiedad
+        return _plain_value(value) if value else None
+    if prop_type == "rollup":
+        if not value:
+            return None
+        if value.get("type") == "array":
+            parts = (_plain_value(item) for item in value.get("array") or [])
+            return ", ".join(part for part in parts if part) or None
+        return _plain_value(value)
+    if prop_type == "relation":
+        return ", ".join(item.get("id", "") for item in value or []) or None
+    if prop_type == "people":
+        return ", ".join(_user_name(user) for user in value or []) or None
+    if prop_type in ("created_by", "last_edited_by"):
+        return _user_name(value) if value else None
+    if prop_type == "unique_id":
+        if not value or value.get("number") is None:
+            return None
+        prefix = value.get("prefix")
+        return f"{prefix}-{value['number']}" if prefix else str(value["number"])
+    if prop_type == "files":
+        return ", ".join(item.get("name", "") for item in value or []) or None
+    return None
+
+def _user_name(user):
+    """Nombre de un usuario de Notion (su ID si la integración no ve el nombre)."""
+    return user.get("name") or user.get("id", "")
+
+def page_record(page):
+    """Convierte una página de la API en la fila que guarda el espejo."""
+    props = {}
+    title = None
+    for name, prop in page.get("properties", {}).items():
+        value = _plain_value(prop)
+        if prop.get("type") == "title":
+            title = value
+        if value is not None:
+            props[name] = value
+    return {
+        "page_id": normalize_id(page["id"]),
+        "notion_id": page["id"],
+        "title": title or "Sin título",
+        "url": page.get("url"),
+        "props": props,
+        "last_edited_time": page.get("last_edited_time"),
+        "archived": bool(page.get("archived") or page.get("in_trash")),
+    }
+
+def _row_to_page(row):
+    return {
+        "id": row[0],
+        "database_id": row[1],
+        "title": row[2],
+        "url": row[3],
+        "props": json.loads(row[4]) if row[4] else {},
+        "last_edited_time": row[5],
+    }
+
+def _index_columns(database_id):
+    """Columnas de descripción y tipo de la BD según su esquema en caché (o las de la plantilla)."""
+    schema = notion_schema.peek(database_id)
+    description = (schema and schema.role_property("description")) or notion_schema.DESCRIPTION_PROPERTY
+    type_val = (schema and schema.role_property("type_val")) or notion_schema.TYPE_PROPERTY
+    return description, type_val
+
+def _index_fields(record, columns):
+    """Campos del índice de búsqueda: título, descripción y tipo."""
+    props = record["props"]
+    return {
+        "title": record["title"],
+        "description": props.get(columns[0]),
+        "type": props.get(columns[1]),
+    }
+
+def _index_payload(record):
+    return {"id": record["notion_id"], "title": record["title"], "url": record["url"]}
+
+class NotionMirror:
+    """
+    Copia local (SQLite) de las páginas de cada base de datos de Notion.
+    Las búsquedas, listados y consultas por ID se resuelven aquí; Notion
+    solo se consulta para el backfill inicial y los cambios recientes.
+    Cada BD tiene además dos índices en memoria para /buscar (texto
+    completo y trigramas para erratas), que se construyen al primer uso y
+    se mantienen con cada cambio.
+    """
+
+    def __init__(self, path=MIRROR_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._indexes = {}  # database_id -> InvertedIndex
+        self._fuzzy = {}    # database_id -> TrigramIndex
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                page_id TEXT PRIMARY KEY,
+                database_id TEXT NOT NULL,
+                title TEXT,
+                url TEXT,
+                props TEXT,
+                last_edited_time TEXT,
+                notion_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS pages_by_db_edit
+                ON pages (database_id, last_edited_time);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                database_id TEXT PRIMARY KEY,
+                last_edited_time TEXT,
+                synced_at REAL,
+                full_synced_at REAL
+            );
+        """)
+
+    def upsert_pages(self, database_id, pages):
+        """Guarda (o borra, si están archivadas) páginas devueltas por la API."""
+        database_id = normalize_id(database_id)
+        changed = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                index = self._indexes.get(database_id)
+                fuzzy = self._fuzzy.get(database_id)
+                columns = _index_columns(database_id) if index is not None else None
+                for page in pages:
+                    record = page_record(page)
+                    changed += 1
+                    if record["archived"]:
+                        self._conn.execute("DELETE FROM pages WHERE page_id = ?", (record["page_id"],))
+                        if index is not None:
+                            index.remove(record["page_id"])
+                            fuzzy.remove(record["page_id"])
+                        continue
+                    self._conn.execute(
+                        "INSERT INTO pages (page_id, database_id, title, url, props, last_edited_time, notion_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (page_id) DO UPDATE SET database_id = excluded.database_id, "
+                        "title = excluded.title, url = excluded.url, props = excluded.props, "
+                        "last_edited_time = excluded.last_edited_time, notion_id = excluded.notion_id",
+                        (record["page_id"], database_id, record["title"], record["url"],
+                         json.dumps(record["props"]), record["last_edited_time"], record["notion_id"])
+                    )
+                    if index is not None:
+                        payload = _index_payload(record)
+                        index.add(record["page_id"], _index_fields(record, columns), payload)
+                        fuzzy.add(record["page_id"], record["title"], payload)
+                if index is not None:
+                    # Un lote grande de sync puede mover la longitud media
+                    index.refresh_impacts()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return changed
+
+    def upsert_page(self, page, database_id=None):
+        """Aplica al espejo una página recién creada o editada desde el bot."""
+        database_id = database_id or page.get("parent", {}).get("database_id")
+        if not database_id:
+            return
+        self.upsert_pages(database_id, [page])
+        metrics.incr("notion_mirror.write_through")
+
+    def remove_missing(self, database_id, seen_page_ids):
+        """Borra las páginas que ya no aparecen en Notion tras un sync completo."""
+        database_id = normalize_id(database_id)
+        with self._lock:
+            stored = {row[0] for row in self._conn.execute(
+                "SELECT page_id FROM pages WHERE database_id = ?", (database_id,)
+            )}
+            missing = stored - {normalize_id(page_id) for page_id in seen_page_ids}
+            self._conn.executemany("DELETE FROM pages WHERE page_id = ?", [(p,) for p in missing])
+            index = self._indexes.get(database_id)
+            if index is not None:
+                fuzzy = self._fuzzy[database_id]
+                for page_id in missing:
+                    index.remove(page_id)
+                    fuzzy.remove(page_id)
+        return len(missing)
+
+    def get_page(self, page_id):
+        """Página por ID (con o sin guiones), o None si no está en el espejo."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT notion_id, database_id, title, url, props, last_edited_time "
+                "FROM pages WHERE page_id = ?", (normalize_id(page_id),)
+            ).fetchone()
+        if row:
+            metrics.incr("notion_mirror.lookups")
+        return _row_to_page(row) if row else None
+
+    def list_pages(self, database_id, limit=10, offset=0):
+        """Páginas de una BD, las editadas más recientemente primero."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT notion_id, database_id, title, url, props, last_edited_time "
+                "FROM pages WHERE database_id = ? "
+                "ORDER BY last_edited_time DESC LIMIT ? OFFSET ?",
+                (normalize_id(database_id), limit, offset)
+            ).fetchall()
+        return [_row_to_page(row) for row in rows]
+
+    def _build_indexes(self, database_id):
+        """Construye desde SQLite los índices de búsqueda de la BD (con el lock tomado)."""
+        index = search_index.InvertedIndex()
+        fuzzy = search_index.TrigramIndex()
+        columns = _index_columns(database_id)
+        rows = self._conn.execute(
+            "SELECT page_id, notion_id, title, url, props FROM pages WHERE database_id = ?",
+            (database_id,)
+        )
+        for page_id, notion_id, title, url, props in rows:
+            record = {
+                "page_id": page_id,
+                "notion_id": notion_id,
+                "title": title,
+                "url": url,
+                "props": json.loads(props) if props else {},
+            }
+            payload = _index_payload(record)
+            index.add(page_id, _index_fields(record, columns), payload)
+            fuzzy.add(page_id, title, payload)
+        index.refresh_impacts()
+        self._indexes[database_id] = index
+        self._fuzzy[database_id] = fuzzy
+        metrics.incr("notion_mirror.index_builds")
+
+    def index(self, database_id):
+        """Índice de texto completo de la BD, construido la primera vez que se usa."""
+        database_id = normalize_id(database_id)
+        with self._lock:
+            if database_id not in self._indexes:
+                self._build_indexes(database_id)
+            return self._indexes[database_id]
+
+    def fuzzy_index(self, database_id):
+        """Índice de trigramas de la BD, construido la primera vez que se usa."""
+        database_id = normalize_id(database_id)
+        with self._lock:
+            if database_id not in self._fuzzy:
+                self._build_indexes(database_id)
+            return self._fuzzy[database_id]
+
+    def search(self, database_id, query, limit=10):
+        """
+        Búsqueda de texto completo (título, descripción y tipo) ordenada por
+        relevancia. Ignora tildes, admite prefijos y palabras en cualquier orden.
+        """
+        index = self.index(database_id)
+        with self._lock:
+            hits = index.search(query, limit)
+        metrics.incr("notion_mirror.searches")
+        return [payload for _, payload in hits]
+
+    def fuzzy_search(self, database_id, query, limit=10):
+        """
+        Títulos parecidos a query aunque tenga erratas ("conprar" → "Comprar").
+        Cada resultado lleva además su similitud (0-1).
+        """
+        index = self.fuzzy_index(database_id)
+        with self._lock:
+            hits = index.search(query, limit)
+        metrics.incr("notion_mirror.fuzzy_searches")
+        return [dict(payload, similarity=similarity) for similarity, payload in hits]
+
+    def index_memory(self):
+        """Memoria de los índices de trigramas, sumando todas las BDs cargadas."""
+        with self._lock:
+            stats = [index.memory_stats() for index in self._fuzzy.values()]
+        docs = sum(s["docs"] for s in stats)
+        total = sum(s["bytes"] for s in stats)
+        return {
+            "docs": docs,
+            "bytes": total,
+            "bytes_per_title": total / docs if docs else 0.0,
+        }
+
+    def count(self, database_id):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM pages WHERE database_id = ?", (normalize_id(database_id),)
+            ).fetchone()[0]
+
+    def sync_state(self, database_id):
+        """Devuelve (last_edited_time, synced_at, full_synced_at) o None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT last_edited_time, synced_at, full_synced_at FROM sync_state WHERE database_id = ?",
+                (normalize_id(database_id),)
+            ).fetchone()
+
+    def mark_synced(self, database_id, last_edited_time, full=False):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (database_id, last_edited_time, synced_at, full_synced_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (database_id) DO UPDATE SET "
+                "last_edited_time = COALESCE(excluded.last_edited_time, sync_state.last_edited_time), "
+                "synced_at = excluded.synced_at, "
+                "full_synced_at = COALESCE(excluded.full_synced_at, sync_state.full_synced_at)",
+                (normalize_id(database_id), last_edited_time, now, now if full else None)
+            )
+
+    def is_ready(self, database_id):
+        """True si la BD ya tuvo al menos un sync completo."""
+        state = self.sync_state(database_id)
+        return bool(state and state[2])
+
+    def sync_plan(self, database_id):
+        """
+        Decide qué sync toca: None (espejo al día), "incremental" o "full".
+        Devuelve (tipo, filtro para databases.query).
+        """
+        state = self.sync_state(database_id)
+        now = time.time()
+        if not state or not state[2] or now - state[2] > FULL_SYNC_INTERVAL:
+            return "full", None
+        if now - (state[1] or 0) < SYNC_INTERVAL:
+            return None, None
+        if not state[0]:
+            return "incremental", None
+        # last_edited_time viene redondeado al minuto: on_or_after repite
+        # las páginas de ese minuto, pero el upsert es idempotente
+        return "incremental", {
+            "timestamp": "last_edited_time",
+            "last_edited_time": {"on_or_after": state[0]}
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_mirror = None
+_mirror_lock = threading.Lock()
+
+def get_mirror():
+    """Espejo compartido del proceso (None si está desactivado)."""
+    global _mirror
+    if not MIRROR_ENABLED:
+        return None
+    if _mirror is None:
+        with _mirror_lock:
+            if _mirror is None:
+                _mirror = NotionMirror(MIRROR_DB)
+    return _mirror
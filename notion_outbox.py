@@ -0,0 +1,551 @@
+import asyncio
+import dataclasses
+import functools
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+import async_notion_service
+import metrics
+import notion_mirror
+from client_pool import token_key
+from retry_policy import _retry_after
+from user_session import UserSession
+
+logger = logging.getLogger(__name__)
+
+# Cola persistente de escrituras a Notion. Los handlers encolan la
+# creación/edición, responden "en cola" al momento y un worker en segundo
+# plano la aplica cuando Notion responde, editando después ese mensaje.
+# Si Notion está caído o limitando, la tarea espera en disco y se reintenta,
+# también tras reiniciar el bot.
+
+OUTBOX_DB = os.getenv("NOTION_OUTBOX_DB", "notion_outbox.db")
+# Intentos del worker (cada uno ya incluye los reintentos cortos de NOTION_RETRY)
+MAX_ATTEMPTS = int(os.getenv("NOTION_OUTBOX_MAX_ATTEMPTS", "10"))
+BASE_BACKOFF = 5.0
+MAX_BACKOFF = 600.0
+# Entradas que el worker toma por pasada
+BATCH_SIZE = 50
+# Aunque nadie lo despierte, el worker revisa la cola con esta frecuencia
+IDLE_POLL = 30.0
+# Segundos que espera una edición por si llegan más para la misma página:
+# todas las pendientes se envían juntas en un solo pages.update
+EDIT_COALESCE_WINDOW = float(os.getenv("NOTION_EDIT_COALESCE_WINDOW", "2"))
+# Las entradas terminadas se guardan este tiempo (segundos) para deduplicar
+# updates reentregados y poder revisarlas; después se borran
+RETENTION = float(os.getenv("NOTION_OUTBOX_RETENTION", "604800"))
+# Cada cuánto borra el worker las entradas terminadas y caducadas
+PRUNE_INTERVAL = 3600.0
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+@dataclasses.dataclass
+class OutboxEntry:
+    id: int
+    group_id: str
+    user_id: str
+    kind: str
+    database_id: str
+    page_id: str
+    payload: dict
+    chat_id: int
+    message_id: int
+    header: str
+    status: str
+    attempts: int
+    result: dict
+    message: str
+    idem_key: str
+    created_at: float
+    started: int
+
+_COLUMNS = ("id, group_id, user_id, kind, database_id, page_id, payload, chat_id, message_id, "
+            "header, status, attempts, result, message, idem_key, created_at, started")
+
+def _row_to_entry(row):
+    values = list(row)
+    values[6] = json.loads(values[6]) if values[6] else {}
+    values[12] = json.loads(values[12]) if values[12] else None
+    return OutboxEntry(*values)
+
+def _exclude_users(user_ids):
+    """Condición SQL (y parámetros) que deja fuera las entradas de esos usuarios."""
+    if not user_ids:
+        return "", ()
+    # user_id NULL (credenciales globales) se compara como ""
+    keys = tuple(user_id or "" for user_id in user_ids)
+    return f" AND COALESCE(user_id, '') NOT IN ({', '.join('?' * len(keys))})", keys
+
+class NotionOutbox:
+    """
+    Almacén SQLite de las escrituras pendientes. Cada entrada tiene una
+    clave de idempotencia única: encolar dos veces la misma clave (p. ej.
+    un update de Telegram reentregado) no duplica la escritura.
+    """
+
+    def __init__(self, path=OUTBOX_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idem_key TEXT NOT NULL UNIQUE,
+                group_id TEXT NOT NULL,
+                user_id TEXT,
+                kind TEXT NOT NULL,
+                database_id TEXT,
+                page_id TEXT,
+                payload TEXT,
+                chat_id INTEGER,
+                message_id INTEGER,
+                header TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                result TEXT,
+                message TEXT,
+                notified INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+            CREATE INDEX IF NOT EXISTS outbox_group ON outbox (group_id);
+        """)
+
+    def enqueue(self, entries, group_id=None, chat_id=None, message_id=None, header=None, delay=0.0):
+        """
+        Encola un grupo de escrituras en una sola transacción.
+        entries: [dict(idem_key, user_id, kind, database_id, page_id, payload)].
+        delay aplaza el primer intento.
+        Devuelve el group_id (el del grupo original si ya estaba encolado).
+        """
+        group_id = group_id or uuid.uuid4().hex
+        now = time.time()
+        inserted = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for entry in entries:
+                    cursor = self._conn.execute(
+                        "INSERT OR IGNORE INTO outbox (idem_key, group_id, user_id, kind, database_id, "
+                        "page_id, payload, chat_id, message_id, header, next_attempt_at, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (entry["idem_key"], group_id, entry.get("user_id"), entry["kind"],
+                         entry.get("database_id"), entry.get("page_id"), json.dumps(entry.get("payload") or {}),
+                         chat_id, message_id, header, now + delay, now, now)
+                    )
+                    inserted += cursor.rowcount
+                if not inserted and entries:
+                    row = self._conn.execute(
+                        "SELECT group_id FROM outbox WHERE idem_key = ?", (entries[0]["idem_key"],)
+                    ).fetchone()
+                    group_id = row[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        metrics.incr("notion_outbox.enqueued", inserted)
+        if inserted < len(entries):
+            metrics.incr("notion_outbox.duplicates", len(entries) - inserted)
+        return group_id
+
+    def due(self, now=None, limit=BATCH_SIZE, exclude_users=()):
+        """
+        Entradas pendientes cuyo siguiente intento ya toca, en orden de
+        llegada, salvo las de exclude_users (usuarios con un lote en curso).
+        """
+        exclude, params = _exclude_users(exclude_users)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM outbox WHERE status = ? AND next_attempt_at <= ?{exclude} "
+                "ORDER BY id LIMIT ?",
+                (PENDING, now or time.time(), *params, limit)
+            ).fetchall()
+        return [_row_to_entry(row) for row in rows]
+
+    def is_enqueued(self, idem_key):
+        """True si ya hay entradas con esta clave de origen (p. ej. un update reentregado)."""
+        # Las claves de las entradas son "<idem_key>:create:N" o "<idem_key>:update";
+        # ";" es el carácter siguiente a ":", así el rango usa el índice único
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM outbox WHERE idem_key >= ? AND idem_key < ? LIMIT 1",
+                (f"{idem_key}:", f"{idem_key};")
+            ).fetchone()
+        return row is not None
+
+    def pending_updates(self, user_id, page_id):
+        """Ediciones pendientes de una página (aunque aún no toquen), en orden."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM outbox WHERE status = ? AND kind = 'update' "
+                "AND user_id IS ? AND page_id = ? ORDER BY id",
+                (PENDING, user_id, page_id)
+            ).fetchall()
+        return [_row_to_entry(row) for row in rows]
+
+    def seconds_until_due(self, exclude_users=()):
+        """
+        Segundos hasta la próxima entrada pendiente fuera de exclude_users
+        (None si no hay ninguna).
+        """
+        exclude, params = _exclude_users(exclude_users)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?{exclude}", (PENDING, *params)
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def _finish(self, entry_id, status, result=None, message=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, result = ?, message = ?, last_error = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (status, json.dumps(result) if result else None, message, error, time.time(), entry_id)
+            )
+
+    def mark_done(self, entry_id, result, message):
+        self._finish(entry_id, DONE, result=result, message=message)
+
+    def mark_failed(self, entry_id, message, error=None):
+        self._finish(entry_id, FAILED, message=message, error=error)
+
+    def mark_started(self, entry_id):
+        """Anota que la entrada va a llegar a Notion (si el bot cae, se sabrá al reanudar)."""
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET started = started + 1 WHERE id = ?", (entry_id,))
+
+    def mark_retry(self, entry_id, delay, error):
+        """Deja la entrada pendiente y la aplaza delay segundos."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, "
+                "updated_at = ? WHERE id = ?",
+                (now + delay, error, now, entry_id)
+            )
+
+    def group(self, group_id):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM outbox WHERE group_id = ? ORDER BY id", (group_id,)
+            ).fetchall()
+        return [_row_to_entry(row) for row in rows]
+
+    def claim_notification(self, group_id):
+        """
+        True solo para el primero que lo pida cuando todo el grupo terminó,
+        así el mensaje del usuario se edita una vez.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE outbox SET notified = 1 WHERE group_id = ? AND notified = 0 "
+                "AND NOT EXISTS (SELECT 1 FROM outbox WHERE group_id = ? AND status = ?)",
+                (group_id, group_id, PENDING)
+            )
+        return cursor.rowcount > 0
+
+    def prune(self, older_than=RETENTION):
+        """
+        Borra las entradas terminadas (done/failed) hace más de older_than
+        segundos cuyo grupo ya no tiene nada pendiente.
+        Devuelve cuántas se borraron.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM outbox WHERE status IN (?, ?) AND updated_at < ? "
+                "AND NOT EXISTS (SELECT 1 FROM outbox AS other "
+                "WHERE other.group_id = outbox.group_id AND other.status = ?)",
+                (DONE, FAILED, time.time() - older_than, PENDING)
+            )
+        if cursor.rowcount:
+            metrics.incr("notion_outbox.pruned", cursor.rowcount)
+        return cursor.rowcount
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    """Outbox compartido del proceso."""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = NotionOutbox(OUTBOX_DB)
+    return _outbox
+
+def _user_key(session):
+    return str(session.user_id) if session.user_id is not None else None
+
+def enqueue_creates(session, tasks, idem_key=None, chat_id=None, message_id=None, header=None):
+    """
+    Encola la creación de tareas (las de async_gemini_service.extract_tasks) en
+    la BD activa. idem_key identifica el origen (p. ej. el update de
+    Telegram); sin ella no se deduplica. Devuelve el group_id.
+    """
+    idem_key = idem_key or uuid.uuid4().hex
+    entries = [{
+        "idem_key": f"{idem_key}:create:{i}",
+        "user_id": _user_key(session),
+        "kind": "create",
+        "database_id": session.database_id,
+        "payload": {field: task.get(field) for field in ("title", "description", "date", "status", "type_val")},
+    } for i, task in enumerate(tasks)]
+    group_id = get_outbox().enqueue(entries, chat_id=chat_id, message_id=message_id, header=header)
+    wake()
+    return group_id
+
+def is_enqueued(idem_key):
+    """True si el origen idem_key ya está en el outbox (no hay que responder otra vez)."""
+    return get_outbox().is_enqueued(idem_key)
+
+def enqueue_update(session, page_id, fields, idem_key=None, chat_id=None, message_id=None, header=None):
+    """Encola la edición de una página (fields: title, description, date, status, type_val). Devuelve el group_id."""
+    idem_key = idem_key or uuid.uuid4().hex
+    entries = [{
+        "idem_key": f"{idem_key}:update",
+        "user_id": _user_key(session),
+        "kind": "update",
+        "page_id": notion_mirror.normalize_id(page_id),
+        "payload": fields,
+    }]
+    group_id = get_outbox().enqueue(
+        entries, chat_id=chat_id, message_id=message_id, header=header, delay=EDIT_COALESCE_WINDOW
+    )
+    wake()
+    return group_id
+
+def _backoff(attempts, e):
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * (2 ** (attempts - 1))) * random.uniform(0.5, 1.0)
+    retry_after = _retry_after(e)
+    return max(delay, retry_after) if retry_after is not None else delay
+
+def _merge_updates(entries):
+    """Une los cambios de varias ediciones de una página; gana la más reciente."""
+    fields = {}
+    for entry in entries:
+        fields.update({key: value for key, value in entry.payload.items() if value})
+    return fields
+
+async def _apply(entries, session):
+    """
+    Ejecuta contra Notion una creación, o varias ediciones de la misma
+    página combinadas en un solo pages.update, y registra el resultado en
+    cada entrada del outbox.
+    """
+    outbox = get_outbox()
+    entry = entries[0]
+    try:
+        if entry.kind == "create":
+            session = dataclasses.replace(session, database_id=entry.database_id)
+            schema = await async_notion_service._load_create_schema(session, entry.database_id)
+            # Si un intento anterior falló o el bot cayó a mitad, la página
+            # pudo llegar a crearse: se comprueba en Notion antes de repetir
+            outbox.mark_started(entry.id)
+            response, message = await async_notion_service._create_one(
+                session, schema, raise_retryable=True, idem_key=entry.idem_key,
+                reconcile_since=entry.created_at if entry.started else None,
+                **entry.payload
+            )
+        else:
+            response, message = await async_notion_service._update_one(
+                session, entry.page_id, _merge_updates(entries), raise_retryable=True
+            )
+            if len(entries) > 1:
+                metrics.incr("notion_outbox.coalesced", len(entries) - 1)
+                if response:
+                    message = f"✅ Tarea actualizada correctamente ({len(entries)} ediciones en un solo cambio)."
+    except Exception as e:
+        attempts = max(item.attempts for item in entries) + 1
+        if attempts >= MAX_ATTEMPTS:
+            logger.error(f"Outbox: entrada(s) {[item.id for item in entries]} descartada(s) tras {attempts} intentos: {e}")
+            for item in entries:
+                outbox.mark_failed(item.id, "❌ Notion no respondió tras varios intentos; no se guardó.", str(e))
+            metrics.incr("notion_outbox.failed", len(entries))
+        else:
+            delay = _backoff(attempts, e)
+            logger.warning(f"Outbox: entrada(s) {[item.id for item in entries]} fallaron ({e}); reintento en {delay:.0f}s")
+            for item in entries:
+                outbox.mark_retry(item.id, delay, str(e))
+            metrics.incr("notion_outbox.retries", len(entries))
+            return
+    else:
+        for item in entries:
+            if response:
+                outbox.mark_done(item.id, {"id": response["id"], "url": response.get("url")}, message)
+            else:
+                outbox.mark_failed(item.id, message)
+        metrics.incr("notion_outbox.done" if response else "notion_outbox.failed", len(entries))
+    for group_id in dict.fromkeys(item.group_id for item in entries):
+        await _notify(group_id)
+
+def _group_text(entries):
+    """Texto final para el usuario cuando todo el grupo terminó."""
+    header = entries[0].header or ""
+    if len(entries) == 1 or any(entry.kind != "create" for entry in entries):
+        return header + "\n".join(entry.message or "" for entry in entries)
+    return header + async_notion_service.format_created_summary([
+        (entry.payload.get("title"), (entry.result or {}).get("url"), entry.message)
+        for entry in entries
+    ])
+
+async def _notify(group_id):
+    outbox = get_outbox()
+    if _notifier is None or not outbox.claim_notification(group_id):
+        return
+    entries = outbox.group(group_id)
+    if not entries or entries[0].chat_id is None or entries[0].message_id is None:
+        return
+    try:
+        await _notifier(entries[0].chat_id, entries[0].message_id, _group_text(entries))
+    except Exception as e:
+        logger.warning(f"Outbox: no se pudo avisar del grupo {group_id}: {e}")
+
+async def _apply_token_batch(items):
+    """
+    Aplica las entradas de un mismo token, cada una con la sesión de su
+    usuario: páginas distintas en paralelo, compartiendo el cliente y el
+    rate limit del token. Las ediciones de una página se juntan (incluidas
+    las que aún están en su ventana de espera) y salen en una sola petición.
+    """
+    outbox = get_outbox()
+    writes = []
+    seen_pages = set()
+    for entry, session in items:
+        if entry.kind != "update":
+            writes.append(([entry], session))
+        elif (entry.user_id, entry.page_id) not in seen_pages:
+            seen_pages.add((entry.user_id, entry.page_id))
+            writes.append((outbox.pending_updates(entry.user_id, entry.page_id) or [entry], session))
+    await asyncio.gather(*(_apply(write, session) for write, session in writes))
+
+# Lotes en curso por token: token_key -> (tarea, usuarios que esperan a ese token)
+_draining = {}
+
+def _busy_users():
+    return set().union(*(users for _, users in _draining.values()))
+
+def _batch_done(key, task):
+    _draining.pop(key, None)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Outbox: error aplicando un lote: {task.exception()}", exc_info=task.exception())
+    # Puede haber entradas del mismo token esperando a que acabara este lote
+    wake()
+
+async def drain_once():
+    """
+    Lanza las entradas que ya tocan, un lote por token de Notion. Cada lote
+    corre en su propia tarea: un token limitado o lento no retrasa las
+    escrituras de los demás. Los tokens con un lote en curso esperan a que
+    termine. Devuelve cuántas entradas se lanzaron.
+    """
+    outbox = get_outbox()
+    entries = outbox.due(exclude_users=_busy_users())
+    if not entries:
+        return 0
+    sessions = {}
+    batches = {}
+    for entry in entries:
+        session = sessions.get(entry.user_id)
+        if session is None:
+            user_id = int(entry.user_id) if entry.user_id and entry.user_id.isdigit() else entry.user_id
+            session = sessions[entry.user_id] = UserSession.resolve(user_id)
+        if not session.notion_token:
+            outbox.mark_failed(entry.id, "❌ Error: No tienes configurado tu token de Notion. Usa /config")
+            await _notify(entry.group_id)
+            continue
+        key = token_key(session.notion_token)
+        if key in _draining:
+            # Saldrá cuando acabe el lote en curso de su token
+            _draining[key][1].add(entry.user_id)
+            continue
+        batches.setdefault(key, []).append((entry, session))
+    for key, items in batches.items():
+        task = asyncio.ensure_future(_apply_token_batch(items))
+        _draining[key] = (task, {entry.user_id for entry, _ in items})
+        task.add_done_callback(functools.partial(_batch_done, key))
+    return sum(len(items) for items in batches.values())
+
+_notifier = None
+_wakeup = None
+_worker = None
+
+def wake():
+    """Avisa al worker de que hay trabajo nuevo (no hace nada si no está en marcha)."""
+    if _wakeup is not None:
+        _wakeup.set()
+
+async def _run():
+    outbox = get_outbox()
+    next_prune = 0.0
+    while True:
+        _wakeup.clear()
+        try:
+            await drain_once()
+        except Exception as e:
+            logger.error(f"Outbox: error en el worker: {e}", exc_info=True)
+        if time.monotonic() >= next_prune:
+            next_prune = time.monotonic() + PRUNE_INTERVAL
+            try:
+                pruned = outbox.prune()
+                if pruned:
+                    logger.info(f"Outbox: {pruned} entrada(s) terminada(s) borrada(s)")
+            except Exception as e:
+                logger.warning(f"Outbox: no se pudieron borrar las entradas terminadas: {e}")
+        delay = outbox.seconds_until_due(exclude_users=_busy_users())
+        delay = IDLE_POLL if delay is None else min(delay, IDLE_POLL)
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+def start(notifier=None):
+    """
+    Arranca el worker en el event loop actual. notifier(chat_id, message_id,
+    texto) es una corutina que edita el mensaje "en cola" del usuario.
+    """
+    global _notifier, _wakeup, _worker
+    _notifier = notifier
+    if _worker is None:
+        _wakeup = asyncio.Event()
+        _worker = asyncio.ensure_future(_run())
+        pending = get_outbox().pending_count()
+        if pending:
+            logger.info(f"Outbox: {pending} escritura(s) pendiente(s) de la ejecución anterior")
+
+async def stop():
+    """Para el worker; lo pendiente queda en disco para el próximo arranque."""
+    global _worker
+    if _worker is None:
+        return
+    _worker.cancel()
+    batches = [task for task, _ in _draining.values()]
+    for task in batches:
+        task.cancel()
+    await asyncio.gather(_worker, *batches, return_exceptions=True)
+    _draining.clear()
+    _worker = None
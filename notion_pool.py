@@ -0,0 +1,39 @@
+import os
+from contextlib import contextmanager
+from notion_client import AsyncClient, Client
+from client_pool import ClientPool
+
+POOL_SIZE = int(os.getenv("NOTION_POOL_SIZE", "64"))
+IDLE_TTL = float(os.getenv("NOTION_POOL_IDLE_TTL", "300"))
+
+class NotionClientPool(ClientPool):
+    """ClientPool con los valores por defecto de los clientes de Notion."""
+
+    def __init__(self, factory=Client, max_size=POOL_SIZE, idle_ttl=IDLE_TTL, name="notion_pool"):
+        super().__init__(factory, max_size, idle_ttl, name)
+
+_pool = NotionClientPool()
+_async_pool = NotionClientPool(factory=AsyncClient, name="notion_async_pool")
+
+def get_client(token):
+    """Cliente de Notion compartido para el token dado."""
+    return _pool.get(token)
+
+def get_async_client(token):
+    """AsyncClient de Notion compartido para el token dado."""
+    return _async_pool.get(token)
+
+@contextmanager
+def in_use(token):
+    """Marca como ocupados los clientes del token (síncrono y asíncrono) durante una llamada."""
+    with _pool.in_use(token), _async_pool.in_use(token):
+        yield
+
+def close_all():
+    """Cierra todos los clientes síncronos del pool."""
+    _pool.clear()
+
+async def aclose_all():
+    """Cierra todos los clientes, síncronos y asíncronos (al apagar el bot)."""
+    _pool.clear()
+    await _async_pool.aclear()
@@ -0,0 +1,229 @@
+import os
+import logging
+import threading
+import time
+import unicodedata
+from dataclasses import dataclass, field
+from functools import cached_property
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_TTL = float(os.getenv("NOTION_SCHEMA_TTL", "600"))
+
+# Columnas de la plantilla original de la BD de tareas. Si una BD las
+# tiene, se usan; si no, cada rol se busca por tipo y por nombre.
+TITLE_PROPERTY = "Name"
+DESCRIPTION_PROPERTY = "descripcion"
+DATE_PROPERTY = "Fecha de Inicio"
+STATUS_PROPERTY = "Estado del Proyecto"
+TYPE_PROPERTY = "Tipo (Personal, negocio, etc.)"
+
+ROLES = ("title", "description", "date", "status", "type_val")
+
+DEFAULT_NAMES = {
+    "title": TITLE_PROPERTY,
+    "description": DESCRIPTION_PROPERTY,
+    "date": DATE_PROPERTY,
+    "status": STATUS_PROPERTY,
+    "type_val": TYPE_PROPERTY,
+}
+
+# Por rol: tipos de propiedad admitidos (en orden de preferencia) y trozos
+# de nombre (ya en minúsculas y sin tildes) que delatan la columna
+ROLE_TYPES = {
+    "title": ("title",),
+    "description": ("rich_text",),
+    "date": ("date",),
+    "status": ("status", "select"),
+    "type_val": ("select", "multi_select", "rich_text"),
+}
+ROLE_HINTS = {
+    "title": (),
+    "description": ("descrip", "detalle", "nota", "note", "desc"),
+    "date": ("fecha", "date", "inicio", "due", "vence", "plazo"),
+    "status": ("estado", "status"),
+    "type_val": ("tipo", "type", "categor", "area"),
+}
+
+def _rich_text(value):
+    return [{"text": {"content": value}}]
+
+# Cómo se escribe un valor según el tipo real de la propiedad
+ENCODERS = {
+    "title": lambda v: {"title": _rich_text(v)},
+    "rich_text": lambda v: {"rich_text": _rich_text(v)},
+    "date": lambda v: {"date": {"start": v}},
+    "select": lambda v: {"select": {"name": v}},
+    "status": lambda v: {"status": {"name": v}},
+    "multi_select": lambda v: {"multi_select": [{"name": p.strip()} for p in v.split(",") if p.strip()]},
+}
+
+# Sin esquema: los nombres y tipos de la plantilla original
+DEFAULT_ROLES = {
+    "title": (TITLE_PROPERTY, "title"),
+    "description": (DESCRIPTION_PROPERTY, "rich_text"),
+    "date": (DATE_PROPERTY, "date"),
+    "status": (STATUS_PROPERTY, "select"),
+    "type_val": (TYPE_PROPERTY, "rich_text"),
+}
+
+def _fold(name):
+    decomposed = unicodedata.normalize("NFD", name.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def discover_roles(properties):
+    """
+    Asigna a cada rol (title, description, date, status, type_val) una
+    propiedad de la BD: {rol: (nombre, tipo)}. Orden de preferencia: el
+    nombre de la plantilla, un nombre que contenga una pista del rol y, por
+    último, la primera propiedad libre del tipo principal del rol.
+    Los roles sin columna adecuada no aparecen.
+    """
+    roles = {}
+    used = set()
+    for role in ROLES:
+        types = ROLE_TYPES[role]
+        candidates = [
+            (name, prop["type"]) for name, prop in properties.items()
+            if prop["type"] in types and name not in used
+        ]
+        if not candidates:
+            continue
+        default = DEFAULT_NAMES[role]
+        chosen = next((c for c in candidates if c[0] == default), None)
+        if chosen is None:
+            hinted = [c for c in candidates if any(h in _fold(c[0]) for h in ROLE_HINTS[role])]
+            hinted.sort(key=lambda c: types.index(c[1]))
+            chosen = hinted[0] if hinted else None
+        if chosen is None and role in ("title", "date"):
+            # Tipos inequívocos: basta con el tipo
+            chosen = candidates[0]
+        if chosen is None and role == "status":
+            chosen = next((c for c in candidates if c[1] == "status"), None)
+        if chosen is None:
+            continue
+        roles[role] = chosen
+        used.add(chosen[0])
+    return roles
+
+def compile_builder(roles):
+    """
+    Convierte el mapeo de roles en una función fields → properties.
+    Los pasos (clave, nombre, codificador) se resuelven una sola vez.
+    """
+    steps = tuple((role, name, ENCODERS[prop_type]) for role, (name, prop_type) in roles.items())
+
+    def build(fields):
+        properties = {}
+        for role, name, encode in steps:
+            value = fields.get(role)
+            if value:
+                properties[name] = encode(value)
+        return properties
+
+    return build
+
+DEFAULT_BUILDER = compile_builder(DEFAULT_ROLES)
+
+@dataclass
+class DatabaseSchema:
+    """Propiedades de una base de datos de Notion: nombre → tipo y opciones."""
+    database_id: str
+    properties: dict = field(default_factory=dict)
+    fetched_at: float = field(default_factory=time.monotonic)
+
+    def select_options(self, name):
+        """Opciones válidas de un campo select/status (lista vacía si no aplica)."""
+        prop = self.properties.get(name)
+        return list(prop["options"]) if prop else []
+
+    def is_fresh(self, ttl=SCHEMA_TTL):
+        return time.monotonic() - self.fetched_at < ttl
+
+    @cached_property
+    def roles(self):
+        """{rol: (nombre, tipo)} descubierto una vez por esquema leído."""
+        roles = discover_roles(self.properties)
+        missing = [role for role in ROLES if role not in roles]
+        if missing:
+            logger.info(f"BD {self.database_id}: sin columna para {', '.join(missing)}")
+        return roles
+
+    @cached_property
+    def builder(self):
+        """Función fields → properties compilada para esta BD."""
+        return compile_builder(self.roles)
+
+    def role_property(self, role):
+        """Nombre de la propiedad que hace de role en esta BD, o None."""
+        mapped = self.roles.get(role)
+        return mapped[0] if mapped else None
+
+def parse_schema(database_id, db):
+    """Convierte la respuesta de databases.retrieve en un DatabaseSchema."""
+    properties = {}
+    for name, prop in db.get("properties", {}).items():
+        prop_type = prop.get("type")
+        options = []
+        if prop_type in ("select", "multi_select", "status"):
+            options = [opt["name"] for opt in prop.get(prop_type, {}).get("options", [])]
+        properties[name] = {"type": prop_type, "options": options}
+    return DatabaseSchema(database_id=database_id, properties=properties)
+
+_cache = {}  # database_id -> DatabaseSchema
+_lock = threading.Lock()
+
+def get_cached(database_id):
+    """Devuelve el esquema en caché si sigue vigente, o None."""
+    with _lock:
+        schema = _cache.get(database_id)
+    if schema and schema.is_fresh():
+        metrics.incr("notion_schema.hits")
+        return schema
+    metrics.incr("notion_schema.misses")
+    return None
+
+def peek(database_id):
+    """
+    Esquema en caché de la BD (con o sin guiones en el ID) aunque haya
+    caducado, sin contar acierto/fallo; None si nunca se leyó.
+    """
+    key = database_id.replace("-", "").lower()
+    with _lock:
+        for cached_id, schema in _cache.items():
+            if cached_id.replace("-", "").lower() == key:
+                return schema
+    return None
+
+def put(database_id, db):
+    """Guarda en caché la respuesta de databases.retrieve y devuelve el esquema."""
+    schema = parse_schema(database_id, db)
+    with _lock:
+        _cache[database_id] = schema
+    return schema
+
+def get_schema(client, database_id, refresh=False, call=None):
+    """
+    Devuelve el esquema de la BD, consultando a Notion solo si no está en
+    caché, expiró o se pide refresh. call(func, **kwargs) permite ejecutar
+    la petición con reintentos y rate limit.
+    """
+    if not refresh:
+        schema = get_cached(database_id)
+        if schema:
+            return schema
+    if call:
+        db = call(client.databases.retrieve, database_id=database_id)
+    else:
+        db = client.databases.retrieve(database_id=database_id)
+    return put(database_id, db)
+
+def invalidate(database_id=None):
+    """Descarta el esquema de una BD (o todos) para forzar una nueva lectura."""
+    with _lock:
+        if database_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(database_id, None)
+    logger.info(f"Esquema invalidado: {database_id or 'todos'}")
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import threading
+import time
+import metrics
+from client_pool import token_key
+
+# Notion admite de media ~3 peticiones/segundo por integración
+NOTION_RATE = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_BURST = float(os.getenv("NOTION_RATE_BURST", "3"))
+
+class TokenBucket:
+    """
+    Token bucket que encola en lugar de fallar.
+    Cada petición reserva el siguiente hueco libre (los tokens pueden
+    quedar en negativo) y espera hasta su turno, así el orden es FIFO.
+    """
+
+    def __init__(self, rate, burst, name="rate"):
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Consume un token y devuelve cuántos segundos hay que esperar."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            self._waiting += 1
+            return -self._tokens / self.rate
+
+    def _release_waiter(self, wait, cancelled=False):
+        with self._lock:
+            self._waiting -= 1
+            if cancelled:
+                # Devolver el hueco reservado que ya no se va a usar
+                self._tokens += 1
+        self._report(wait)
+
+    def _report(self, wait):
+        metrics.incr(f"{self.name}.acquired")
+        if wait > 0:
+            metrics.incr(f"{self.name}.queued")
+            metrics.observe(f"{self.name}.wait_ms", wait * 1000)
+        metrics.observe(f"{self.name}.queue_depth", self._waiting)
+
+    @property
+    def queue_depth(self):
+        """Peticiones esperando turno en este momento."""
+        return self._waiting
+
+    def acquire(self):
+        """Espera (bloqueando el hilo) hasta poder hacer una petición."""
+        wait = self._reserve()
+        if not wait:
+            self._report(0)
+            return
+        try:
+            time.sleep(wait)
+        except BaseException:
+            self._release_waiter(wait, cancelled=True)
+            raise
+        self._release_waiter(wait)
+
+    async def acquire_async(self):
+        """Espera sin bloquear el event loop hasta poder hacer una petición."""
+        wait = self._reserve()
+        if not wait:
+            self._report(0)
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self._release_waiter(wait, cancelled=True)
+            raise
+        self._release_waiter(wait)
+
+_buckets = {}  # token_key -> TokenBucket
+_buckets_lock = threading.Lock()
+
+def for_notion_token(token):
+    """Bucket compartido por todas las llamadas hechas con el mismo token."""
+    key = token_key(token)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(NOTION_RATE, NOTION_BURST, name="notion_rate")
+    return bucket
+
+def total_queue_depth():
+    """Peticiones a Notion esperando turno, sumando todos los tokens."""
+    with _buckets_lock:
+        return sum(bucket.queue_depth for bucket in _buckets.values())
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import random
+import time
+import httpx
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Códigos HTTP que suelen resolverse solos al reintentar
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# Excepciones sin código HTTP que indican un fallo transitorio de red
+RETRYABLE_NAMES = {"RequestTimeoutError", "DeadlineExceeded", "ServiceUnavailable"}
+
+def _status_of(e):
+    """Código HTTP del error: .status (Notion) o .code entero (google.api_core)."""
+    status = getattr(e, "status", None)
+    if isinstance(status, int):
+        return status
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code
+    return None
+
+def _retry_after(e):
+    """Segundos indicados por la cabecera Retry-After, si el error la trae."""
+    headers = getattr(e, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """
+    Política de reintentos reutilizable para llamadas a APIs externas.
+    Separa errores reintentables (429, 5xx, timeouts, red) de los fatales,
+    respeta Retry-After, aplica backoff exponencial con jitter y no supera
+    un plazo total. Cuenta reintentos en metrics bajo "<name>.retries".
+    """
+
+    def __init__(self, name, max_attempts=3, base_delay=0.5, max_delay=8.0, deadline=20.0):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def is_retryable(self, e):
+        status = _status_of(e)
+        if status is not None:
+            return status in RETRYABLE_STATUS
+        if isinstance(e, (httpx.TransportError, TimeoutError, ConnectionError)):
+            return True
+        return type(e).__name__ in RETRYABLE_NAMES
+
+    def next_delay(self, e, attempt):
+        """Espera antes del siguiente intento (attempt empieza en 1)."""
+        retry_after = _retry_after(e)
+        if retry_after is not None:
+            # Lo que pide Notion más un poco de jitter para no llegar todos a la vez
+            return retry_after + random.uniform(0, self.base_delay)
+        # Full jitter sobre el backoff exponencial
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _should_retry(self, e, attempt, started):
+        """Devuelve la espera si hay que reintentar, o None si hay que propagar."""
+        if not self.is_retryable(e):
+            metrics.incr(f"{self.name}.fatal")
+            return None
+        if attempt >= self.max_attempts:
+            metrics.incr(f"{self.name}.giveups")
+            logger.error(f"[{self.name}] Todos los intentos fallaron: {e}")
+            return None
+        delay = self.next_delay(e, attempt)
+        if time.monotonic() - started + delay > self.deadline:
+            metrics.incr(f"{self.name}.giveups")
+            logger.error(f"[{self.name}] Plazo de {self.deadline}s agotado: {e}")
+            return None
+        metrics.incr(f"{self.name}.retries")
+        logger.warning(f"[{self.name}] Intento {attempt} falló: {e}. Reintentando en {delay:.2f}s...")
+        return delay
+
+    def call(self, func, *args, **kwargs):
+        """Ejecuta func con reintentos (versión síncrona)."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                delay = self._should_retry(e, attempt, started)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def acall(self, func, *args, **kwargs):
+        """Ejecuta await func(...) con reintentos sin bloquear el event loop."""
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._should_retry(e, attempt, started)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
@@ -0,0 +1,320 @@
+import heapq
+import math
+import re
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+from operator import itemgetter
+
+# Palabras demasiado frecuentes para aportar algo al ranking
+STOPWORDS = {
+    "a", "al", "con", "de", "del", "el", "en", "la", "las", "lo", "los",
+    "o", "para", "por", "que", "se", "su", "un", "una", "y"
+}
+
+def _fold_char(ch):
+    # La ñ es una letra distinta en español (año ≠ ano): no se pliega
+    if ch == "ñ":
+        return ch
+    decomposed = unicodedata.normalize("NFD", ch)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+# Tabla precalculada para los caracteres latinos con tilde/diéresis
+_FOLD_TABLE = {
+    code: _fold_char(chr(code))
+    for code in range(0xC0, 0x250)
+    if _fold_char(chr(code)) != chr(code)
+}
+
+def fold(text):
+    """Minúsculas y sin tildes ni diéresis (Reunión → reunion, pingüino → pinguino)."""
+    return unicodedata.normalize("NFC", text).lower().translate(_FOLD_TABLE)
+
+def tokenize(text):
+    """Tokens plegados del texto, sin stopwords."""
+    if not text:
+        return []
+    return [token for token in re.findall(r"\w+", fold(text)) if token not in STOPWORDS]
+
+class InvertedIndex:
+    """
+    Índice invertido en memoria con ranking BM25 sobre varios campos.
+    Cada documento tiene campos de texto con peso propio (el título pesa
+    más que la descripción). Se actualiza documento a documento.
+
+    Las postings guardan el "impacto" BM25 ya calculado (la parte que
+    depende de tf y de la longitud del documento), así buscar es solo
+    sumar idf * impacto. Los impactos se recalculan si la longitud media
+    de los documentos se desvía mucho de la usada al calcularlos.
+    """
+
+    K1 = 1.2
+    B = 0.75
+    # Peso de una coincidencia por prefijo frente a una palabra exacta
+    PREFIX_WEIGHT = 0.7
+    MAX_PREFIX_EXPANSIONS = 64
+    # Desviación de la longitud media que obliga a recalcular impactos
+    AVG_DRIFT = 0.2
+
+    def __init__(self, field_weights=None):
+        self.field_weights = field_weights or {"title": 3.0, "description": 1.0, "type": 1.5}
+        self._postings = {}   # término -> {doc_id: impacto BM25}
+        self._doc_tf = {}     # doc_id -> {término: frecuencia ponderada}
+        self._doc_len = {}    # doc_id -> longitud ponderada
+        self._payloads = {}   # doc_id -> datos a devolver en los resultados
+        self._terms = []      # vocabulario ordenado, para prefijos
+        self._total_len = 0.0
+        self._impact_avg = None  # longitud media usada en los impactos
+
+    def __len__(self):
+        return len(self._doc_len)
+
+    def _avg_len(self):
+        return (self._total_len / len(self._doc_len)) if self._doc_len else 1.0
+
+    def _impact(self, tf, length, avg_len):
+        norm = self.K1 * (1 - self.B + self.B * length / (avg_len or 1.0))
+        return tf * (self.K1 + 1) / (tf + norm)
+
+    def refresh_impacts(self):
+        """
+        Recalcula los impactos si la longitud media se ha desviado (o si
+        nunca se calcularon). Conviene llamarlo al terminar una carga
+        masiva, para que no lo pague la primera búsqueda.
+        """
+        avg_len = self._avg_len()
+        if self._impact_avg is None or abs(avg_len - self._impact_avg) > self.AVG_DRIFT * self._impact_avg:
+            self._refresh_impacts()
+
+    def _refresh_impacts(self):
+        """Recalcula todos los impactos con la longitud media actual."""
+        avg_len = self._avg_len()
+        for doc_id, tfs in self._doc_tf.items():
+            length = self._doc_len[doc_id]
+            for token, tf in tfs.items():
+                self._postings[token][doc_id] = self._impact(tf, length, avg_len)
+        self._impact_avg = avg_len
+
+    def add(self, doc_id, fields, payload=None):
+        """Indexa (o reindexa) un documento con sus campos de texto."""
+        self.remove(doc_id)
+        tfs = {}
+        length = 0.0
+        for field_name, text in fields.items():
+            weight = self.field_weights.get(field_name, 1.0)
+            for token in tokenize(text):
+                tfs[token] = tfs.get(token, 0.0) + weight
+                length += weight
+        self._doc_tf[doc_id] = tfs
+        self._doc_len[doc_id] = length
+        self._payloads[doc_id] = payload
+        self._total_len += length
+        avg_len = self._impact_avg or self._avg_len()
+        for token, tf in tfs.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                insort(self._terms, token)
+            postings[doc_id] = self._impact(tf, length, avg_len)
+
+    def remove(self, doc_id):
+        """Quita un documento del índice (no hace nada si no estaba)."""
+        tfs = self._doc_tf.pop(doc_id, None)
+        if tfs is None:
+            return
+        for token in tfs:
+            postings = self._postings[token]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[token]
+                del self._terms[bisect_left(self._terms, token)]
+        self._total_len -= self._doc_len.pop(doc_id)
+        self._payloads.pop(doc_id, None)
+
+    def _expand(self, token, prefix):
+        """Términos del vocabulario para un token: exacto y, si procede, por prefijo."""
+        expansions = []
+        if token in self._postings:
+            expansions.append((token, 1.0))
+        if prefix:
+            start = bisect_left(self._terms, token)
+            for term in self._terms[start:start + self.MAX_PREFIX_EXPANSIONS + 1]:
+                if not term.startswith(token):
+                    break
+                if term != token:
+                    expansions.append((term, self.PREFIX_WEIGHT))
+        return expansions
+
+    def search(self, query, limit=10, prefix=True):
+        """
+        Devuelve [(score, payload)] ordenado por relevancia BM25.
+        Cada palabra de la consulta también encuentra las que empiezan por ella.
+        """
+        n_docs = len(self._doc_len)
+        if not n_docs or limit <= 0:
+            return []
+        self.refresh_impacts()
+
+        terms = []
+        for token in set(tokenize(query)):
+            for term, term_weight in self._expand(token, prefix):
+                postings = self._postings[term]
+                df = len(postings)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) * term_weight
+                terms.append((df, idf, postings))
+        if not terms:
+            return []
+        # Términos raros primero: aportan más al score y dejan pocos candidatos
+        terms.sort(key=lambda t: t[0])
+
+        if len(terms) == 1:
+            _, idf, postings = terms[0]
+            best = heapq.nlargest(limit, postings.items(), key=itemgetter(1))
+            return [(idf * impact, self._payloads[doc_id]) for doc_id, impact in best]
+
+        scores = {}
+        for df, idf, postings in terms:
+            if len(scores) >= limit and df > 4 * len(scores):
+                # Estrategia "continue": un término muy frecuente solo
+                # reordena los candidatos que ya hay, no añade nuevos
+                for doc_id in scores:
+                    impact = postings.get(doc_id)
+                    if impact:
+                        scores[doc_id] += idf * impact
+                continue
+            get = scores.get
+            for doc_id, impact in postings.items():
+                scores[doc_id] = get(doc_id, 0.0) + idf * impact
+        best = heapq.nlargest(limit, scores.items(), key=itemgetter(1))
+        return [(score, self._payloads[doc_id]) for doc_id, score in best]
+
+def trigrams(text):
+    """
+    Trigramas de las palabras del texto (plegadas), con relleno al estilo
+    pg_trgm: "cita" → "  c", " ci", "cit", "ita", "ta ".
+    """
+    grams = set()
+    for word in tokenize(text):
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(sys.intern(padded[i:i + 3]))
+    return grams
+
+class TrigramIndex:
+    """
+    Índice de trigramas sobre los títulos para búsqueda tolerante a erratas
+    ("reunoin" encuentra "Reunión"). La similitud es la fracción de
+    trigramas de la consulta presentes en el título.
+
+    Los candidatos salen solo de los trigramas más raros de la consulta
+    (filtro de prefijo): para llegar al umbral un título tiene que contener
+    al menos uno de ellos. Cada candidato se verifica contra sus propios
+    trigramas, así que el coste depende de la consulta y de lo frecuentes
+    que sean esos trigramas, no del total de tareas.
+
+    Para ocupar poco, los trigramas se guardan como enteros, las postings
+    como array("I") de IDs internos, y los borrados se marcan (el ID
+    interno deja de existir) y se compactan cuando se acumulan.
+    """
+
+    THRESHOLD = 0.4
+
+    def __init__(self):
+        self._gram_ids = {}   # trigrama -> entero
+        self._postings = []   # entero de trigrama -> array("I") de IDs internos
+        self._docs = {}       # ID interno -> (doc_id, tuple de trigramas, payload)
+        self._internal = {}   # doc_id -> ID interno
+        self._next_id = 0
+        self._dead = 0        # entradas de postings de documentos ya borrados
+        self._live = 0        # entradas de postings de documentos vivos
+
+    def __len__(self):
+        return len(self._docs)
+
+    def _gram_id(self, gram):
+        gram_id = self._gram_ids.get(gram)
+        if gram_id is None:
+            gram_id = self._gram_ids[gram] = len(self._postings)
+            self._postings.append(array("I"))
+        return gram_id
+
+    def add(self, doc_id, title, payload=None):
+        """Indexa (o reindexa) el título de un documento."""
+        self.remove(doc_id)
+        grams = tuple(sorted(self._gram_id(gram) for gram in trigrams(title)))
+        internal = self._next_id
+        self._next_id += 1
+        self._internal[doc_id] = internal
+        self._docs[internal] = (doc_id, grams, payload)
+        self._live += len(grams)
+        for gram_id in grams:
+            self._postings[gram_id].append(internal)
+
+    def remove(self, doc_id):
+        """Quita un documento del índice (no hace nada si no estaba)."""
+        internal = self._internal.pop(doc_id, None)
+        if internal is None:
+            return
+        _, grams, _ = self._docs.pop(internal)
+        self._dead += len(grams)
+        self._live -= len(grams)
+        if self._dead > 1000 and self._dead > self._live:
+            self._compact()
+
+    def _compact(self):
+        """Reconstruye las postings sin los documentos borrados."""
+        postings = [array("I") for _ in self._postings]
+        for internal, (_, grams, _) in self._docs.items():
+            for gram_id in grams:
+                postings[gram_id].append(internal)
+        self._postings = postings
+        self._dead = 0
+
+    def search(self, query, limit=10, threshold=None):
+        """Devuelve [(similitud, payload)] de los títulos parecidos a query."""
+        threshold = self.THRESHOLD if threshold is None else threshold
+        query_grams = trigrams(query)
+        n_grams = len(query_grams)
+        if not n_grams or limit <= 0:
+            return []
+        need = max(1, math.ceil(n_grams * threshold))
+        query_ids = {self._gram_ids[gram] for gram in query_grams if gram in self._gram_ids}
+        # Los trigramas que no están en el índice no pueden coincidir
+        probe = len(query_ids) - need + 1
+        if probe <= 0:
+            return []
+        rarest = sorted((self._postings[gram_id] for gram_id in query_ids), key=len)[:probe]
+        candidates = set().union(*rarest)
+
+        scored = []
+        for internal in candidates:
+            doc = self._docs.get(internal)
+            if doc is None:
+                continue
+            shared = len(query_ids.intersection(doc[1]))
+            if shared < need:
+                continue
+            # Desempate: a igual cobertura, el título con menos palabras sobrantes
+            dice = 2 * shared / (n_grams + len(doc[1]))
+            scored.append((shared / n_grams, dice, internal))
+        best = heapq.nlargest(limit, scored)
+        return [(similarity, self._docs[internal][2]) for similarity, _, internal in best]
+
+    def memory_stats(self):
+        """
+        Memoria aproximada del índice (sys.getsizeof de sus estructuras, sin
+        contar los doc_id ni los payloads, que comparte con el espejo).
+        """
+        total = (sys.getsizeof(self._gram_ids) + sys.getsizeof(self._postings)
+                 + sys.getsizeof(self._docs) + sys.getsizeof(self._internal))
+        total += sum(sys.getsizeof(gram) for gram in self._gram_ids)
+        total += sum(sys.getsizeof(postings) for postings in self._postings)
+        total += sum(sys.getsizeof(doc) + sys.getsizeof(doc[1]) for doc in self._docs.values())
+        docs = len(self._docs)
+        return {
+            "docs": docs,
+            "trigrams": len(self._gram_ids),
+            "bytes": total,
+            "bytes_per_title": total / docs if docs else 0.0,
+        }
@@ -0,0 +1,175 @@
+import os
+import re
+import unicodedata
+import date_utils
+
+# Extractor determinista para las entradas sencillas de /plan ("Comprar
+# leche mañana tipo:Personal"). Devuelve la tarea y una confianza entre 0
+# y 1; gemini_service solo llama al LLM cuando la confianza no llega a
+# MIN_CONFIDENCE. Ante la duda la confianza baja: un fallo aquí crea una
+# tarea mal hecha, uno del lado del LLM solo cuesta un segundo más.
+
+MIN_CONFIDENCE = float(os.getenv("GEMINI_RULES_MIN_CONFIDENCE", "0.8"))
+
+DEFAULT_STATUS = "Por hacer"
+
+# Claves aceptadas en "campo:valor" (sin tildes, en minúsculas)
+FIELD_KEYS = {
+    "tipo": "type_val", "type": "type_val", "proyecto": "type_val",
+    "estado": "status", "status": "status",
+    "fecha": "date_raw", "date": "date_raw", "para": "date_raw",
+    "desc": "description", "descripcion": "description", "nota": "description",
+}
+
+# campo:valor o campo:"valor con espacios"; "_" en el valor cuenta como espacio.
+# Sin comillas, el valor llega hasta el siguiente campo: o el final del texto
+# ("estado:Por hacer tipo:Negocio")
+FIELD_RE = re.compile(
+    r'(?<!\S)([A-Za-zÁÉÍÓÚáéíóúñÑ]+):'
+    r'(?:"([^"]*)"|(\S+(?:\s+(?![A-Za-zÁÉÍÓÚáéíóúñÑ]+:)\S+)*))'
+)
+
+# Palabras que como mucho lleva un estado o un tipo ("En progreso"); si hay
+# más, probablemente el valor se tragó parte del título
+MAX_OPTION_WORDS = 2
+
+WEEKDAYS = r"lunes|martes|mi[eé]rcoles|jueves|viernes|s[aá]bado|domingo"
+# Expresiones que date_utils.parse_spanish_date sabe resolver, con su
+# preposición delante para quitarlas también del título
+DATE_RE = re.compile(
+    r"(?:\b(?:para|el|hasta|antes\s+del?)\s+)*"
+    r"\b(pasado\s+mañana|mañana|hoy|en\s+\d+\s+d[ií]as?"
+    r"|(?:(?:el\s+)?(?:pr[oó]ximo|siguiente)\s+)?(?:" + WEEKDAYS + r")"
+    r"|\d{4}-\d{2}-\d{2})\b",
+    re.IGNORECASE,
+)
+
+# "por la mañana", "esta mañana": franja del día, no fecha
+MORNING_RE = re.compile(r"\b(?:la|esta|una)\s+mañana\b", re.IGNORECASE)
+
+# Fechas u horas que date_utils no entiende: mejor que las lea el LLM
+VAGUE_DATE_RE = re.compile(
+    r"\b(?:semana\s+que\s+viene|fin\s+de\s+(?:semana|mes)|mes\s+que\s+viene"
+    r"|a\s+las?\s+\d{1,2}|\d{1,2}[:h]\d{2}|\d{1,2}\s*(?:am|pm|h)|\d{1,2}/\d{1,2}"
+    r"|(?:antes|después|despues)\s+de\s+las?\s+\d{1,2}|el\s+\d{1,2}"
+    r"|(?:el\s+)?\d{1,2}\s+de\s+[a-z]+|tarde|noche|luego|después|despues)\b",
+    re.IGNORECASE,
+)
+
+# Señales de que el texto trae varias tareas
+LIST_RE = re.compile(r"[,;\n•]|\s(?:y|e|también|tambien|además|ademas)\s|^\s*\d+[.)]", re.IGNORECASE)
+
+# Palabras sueltas que quedan colgando al quitar la fecha
+TRAILING_WORDS = {"para", "el", "la", "de", "a", "en", "hasta", "antes", "del"}
+
+MAX_TITLE_WORDS = 8
+
+def _fold(text):
+    return "".join(
+        c for c in unicodedata.normalize("NFD", text.lower()) if unicodedata.category(c) != "Mn"
+    )
+
+def _take_fields(text):
+    """
+    Saca los campo:valor del texto. Retorna (texto restante, campos,
+    claves desconocidas, valores sospechosos).
+    """
+    fields = {}
+    unknown = 0
+    suspicious = 0
+
+    def replace(match):
+        nonlocal unknown, suspicious
+        key = FIELD_KEYS.get(_fold(match.group(1)))
+        if key is None:
+            # "Nota:" o una URL dentro del título: no es de la gramática
+            unknown += 1
+            return match.group(0)
+        if match.group(2) is not None:
+            value = match.group(2)
+        else:
+            value = match.group(3).replace("_", " ")
+            if key in ("status", "type_val") and (
+                len(value.split()) > MAX_OPTION_WORDS or DATE_RE.search(value) or VAGUE_DATE_RE.search(value)
+            ):
+                # "tipo:Personal mañana": el valor sin comillas se llevó palabras libres
+                suspicious += 1
+        fields[key] = value.strip() or None
+        return " "
+
+    return FIELD_RE.sub(replace, text), fields, unknown, suspicious
+
+def _capitalize(value):
+    # Las opciones de Notion suelen ir con mayúscula ("En progreso") y se comparan tal cual
+    return value[:1].upper() + value[1:] if value else value
+
+def _clean_title(text):
+    words = text.split()
+    while words and _fold(words[-1]) in TRAILING_WORDS:
+        words.pop()
+    while words and _fold(words[0]) in TRAILING_WORDS:
+        words.pop(0)
+    return _capitalize(" ".join(words).strip(" .-:"))
+
+def extract(text):
+    """
+    Extrae una tarea de text sin LLM.
+    Retorna (tarea, confianza) con las mismas claves que gemini_service
+    (title, description, date_raw, date, status, type_val).
+    """
+    text = (text or "").strip()
+    if not text:
+        return None, 0.0
+
+    confidence = 1.0
+    rest, fields, unknown, suspicious = _take_fields(text)
+    if unknown:
+        confidence *= 0.5
+    if suspicious:
+        confidence *= 0.4
+
+    if LIST_RE.search(rest):
+        confidence *= 0.3
+
+    date_raw = fields.get("date_raw")
+    if MORNING_RE.search(rest):
+        confidence *= 0.5
+    elif date_raw is None:
+        matches = list(DATE_RE.finditer(rest))
+        if len(matches) > 1:
+            confidence *= 0.3
+        if matches:
+            date_raw = re.sub(r"\s+", " ", matches[0].group(1)).lower()
+            rest = rest[:matches[0].start()] + " " + rest[matches[0].end():]
+    if VAGUE_DATE_RE.search(rest):
+        confidence *= 0.4
+
+    date = date_utils.parse_spanish_date(date_raw) if date_raw else None
+    if date_raw and date is None:
+        confidence *= 0.3
+
+    title = _clean_title(rest)
+    words = len(title.split())
+    if words == 0:
+        return None, 0.0
+    if words > MAX_TITLE_WORDS:
+        # Frases largas suelen traer descripción o matices que el LLM separa mejor
+        confidence *= 0.6
+
+    task = {
+        "title": title,
+        "description": fields.get("description"),
+        "date_raw": date_raw,
+        "date": date,
+        "status": _capitalize(fields.get("status")) or DEFAULT_STATUS,
+        "type_val": _capitalize(fields.get("type_val")),
+    }
+    return task, round(confidence, 3)
+
+def extract_confident(text, min_confidence=None):
+    """La tarea de extract si la confianza llega al umbral; None si hay que preguntar al LLM."""
+    task, confidence = extract(text)
+    threshold = MIN_CONFIDENCE if min_confidence is None else min_confidence
+    if task is None or confidence < threshold:
+        return None
+    return task
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+import time
+from telegram.error import BadRequest, RetryAfter, TelegramError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Respuesta de Telegram que se va escribiendo sobre la marcha: el primer
+# trozo se envía en cuanto llega y los siguientes editan el mismo mensaje,
+# como mucho una vez cada EDIT_INTERVAL segundos (Telegram limita las
+# ediciones por chat). Si el texto pasa de MESSAGE_LIMIT caracteres, el
+# mensaje se cierra y se sigue en uno nuevo.
+
+MESSAGE_LIMIT = 4096
+EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
+# Indicador de que la respuesta sigue llegando
+CURSOR = " ▌"
+
+def split_point(text, limit=MESSAGE_LIMIT):
+    """Dónde cortar text para que la primera parte quepa en limit: salto de línea, espacio o a pelo."""
+    if len(text) <= limit:
+        return len(text)
+    for sep in ("\n", " "):
+        cut = text.rfind(sep, limit // 2, limit)
+        if cut > 0:
+            return cut + 1
+    return limit
+
+class StreamingMessage:
+    """Mensaje (o mensajes, si no cabe) que se edita a medida que crece el texto."""
+
+    def __init__(self, bot, chat_id, edit_interval=EDIT_INTERVAL, limit=MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        # Se reserva sitio para el cursor en las partes que aún crecen
+        self.limit = limit - len(CURSOR)
+        self.text = ""
+        self._start = 0  # dónde empieza en text la parte del mensaje actual
+        self._message_id = None
+        self._shown = None  # texto que muestra ahora el mensaje actual
+        self._next_edit = 0.0
+
+    async def update(self, text):
+        """Nuevo texto acumulado; solo se envía si toca según el intervalo."""
+        self.text = text
+        await self._flush_full_parts()
+        if self._message_id is not None and time.monotonic() < self._next_edit:
+            metrics.incr("telegram_stream.skipped_edits")
+            return
+        await self._show(self.text[self._start:] + CURSOR)
+
+    async def finish(self, text=None):
+        """Escribe el texto final sin cursor, esperando al límite de Telegram si hace falta."""
+        if text is not None:
+            self.text = text
+        await self._flush_full_parts()
+        part = self.text[self._start:]
+        if part.strip():
+            await self._show(part, wait=True)
+        elif not self.text.strip():
+            # Sin texto en absoluto: al menos un mensaje para no dejar al usuario esperando
+            await self._show("…", wait=True)
+
+    async def _flush_full_parts(self):
+        # Las partes que ya no caben se cierran con su texto definitivo
+        while len(self.text) - self._start > self.limit:
+            cut = self._start + split_point(self.text[self._start:], self.limit)
+            await self._show(self.text[self._start:cut], wait=True)
+            self._start = cut
+            self._message_id = None
+            self._shown = None
+
+    async def _show(self, part, wait=False):
+        if part == self._shown:
+            return
+        while True:
+            try:
+                if self._message_id is None:
+                    message = await self.bot.send_message(chat_id=self.chat_id, text=part)
+                    self._message_id = message.message_id
+                    metrics.incr("telegram_stream.messages")
+                else:
+                    await self.bot.edit_message_text(
+                        chat_id=self.chat_id, message_id=self._message_id, text=part
+                    )
+                    metrics.incr("telegram_stream.edits")
+                self._shown = part
+                self._next_edit = time.monotonic() + self.edit_interval
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                metrics.incr("telegram_stream.retry_after")
+                if not wait:
+                    # Una edición intermedia se puede saltar: la siguiente ya llevará el texto
+                    self._next_edit = time.monotonic() + retry_after
+                    return
+                await asyncio.sleep(retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self._shown = part
+                    return
+                logger.warning(f"No se pudo actualizar el mensaje en streaming: {e}")
+                return
+            except TelegramError as e:
+                logger.warning(f"No se pudo actualizar el mensaje en streaming: {e}")
+                return
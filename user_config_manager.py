@@ -1,45 +1,39 @@
-import json
+import atexit
 import os
 import logging
+import threading
 from datetime import datetime
+import user_config_store
 
 logger = logging.getLogger(__name__)
 
-CONFIG_FILE = "users_config.json"
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Devuelve el backend de configuración del proceso (se crea al primer uso)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = user_config_store.create_store()
+    return _store
 
 def load_config():
     """Carga la configuración de todos los usuarios."""
-    if not os.path.exists(CONFIG_FILE):
-        return {}
-    try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Error cargando users_config.json: {e}", exc_info=True)
-        return {}
+    return get_store().load_all()
 
 def save_config(config):
-    """Guarda la configuración de todos los usuarios."""
-    try:
-        with open(CONFIG_FILE, "w") as f:
-            json.dump(config, f, indent=2)
-    except Exception as e:
-        logger.error(f"Error guardando users_config.json: {e}", exc_info=True)
-
-def _create_default_user_config():
-    """Crea una configuración por defecto para un nuevo usuario."""
-    return {
-        "gemini_api_key": None,
-        "notion_token": None,
-        "notion_databases": {},
-        "current_db_alias": None,
-        "created_at": datetime.now().isoformat()
-    }
+    """Guarda la configuración de todos los usuarios (solo backend JSON)."""
+    store = get_store()
+    if hasattr(store, "save_all"):
+        store.save_all(config)
+    else:
+        store.import_config(config)
 
 def get_user_config(user_id):
     """Obtiene la configuración de un usuario específico."""
-    config = load_config()
-    return config.get(str(user_id), None)
+    return get_store().get_user(user_id)
 
 def has_user_config(user_id):
     """Verifica si un usuario tiene configuración."""
@@ -50,61 +44,38 @@ def has_user_config(user_id):
 
 def set_user_gemini_key(user_id, api_key):
     """Configura la API key de Gemini para un usuario."""
-    config = load_config()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in config:
-        config[user_id_str] = _create_default_user_config()
-    
-    config[user_id_str]["gemini_api_key"] = api_key
-    config[user_id_str]["updated_at"] = datetime.now().isoformat()
-    save_config(config)
+    get_store().upsert_user(user_id, {
+        "gemini_api_key": api_key,
+        "updated_at": datetime.now().isoformat()
+    })
     logger.info(f"Usuario {user_id} configuró Gemini API key")
 
 def set_user_notion_token(user_id, notion_token):
     """Configura el token de Notion para un usuario."""
-    config = load_config()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in config:
-        config[user_id_str] = _create_default_user_config()
-    
-    config[user_id_str]["notion_token"] = notion_token
-    config[user_id_str]["updated_at"] = datetime.now().isoformat()
-    save_config(config)
+    get_store().upsert_user(user_id, {
+        "notion_token": notion_token,
+        "updated_at": datetime.now().isoformat()
+    })
     logger.info(f"Usuario {user_id} configuró Notion token")
 
 def add_user_database(user_id, alias, db_id):
     """Añade una base de datos de Notion para un usuario."""
-    config = load_config()
-    user_id_str = str(user_id)
-    
-    if user_id_str not in config:
-        config[user_id_str] = _create_default_user_config()
-    
-    config[user_id_str]["notion_databases"][alias] = db_id
-    
-    # Si es la primera BD, establecerla como activa
-    if not config[user_id_str]["current_db_alias"]:
-        config[user_id_str]["current_db_alias"] = alias
-    
-    save_config(config)
+    # Si es la primera BD, el backend la establece como activa
+    get_store().add_database(user_id, alias, db_id)
     logger.info(f"Usuario {user_id} añadió BD '{alias}'")
     return True
 
 def set_user_current_database(user_id, alias):
     """Establece la base de datos activa para un usuario."""
-    config = load_config()
-    user_id_str = str(user_id)
+    user_config = get_user_config(user_id)
     
-    if user_id_str not in config:
+    if not user_config:
         return False
     
-    if alias not in config[user_id_str]["notion_databases"]:
+    if alias not in user_config.get("notion_databases", {}):
         return False
     
-    config[user_id_str]["current_db_alias"] = alias
-    save_config(config)
+    get_store().upsert_user(user_id, {"current_db_alias": alias})
     logger.info(f"Usuario {user_id} cambió BD activa a '{alias}'")
     return True
 
@@ -170,12 +141,17 @@ def get_user_current_alias(user_id):
 
 def delete_user_config(user_id):
     """Elimina la configuración de un usuario (comando /reset_config)."""
-    config = load_config()
-    user_id_str = str(user_id)
-    
-    if user_id_str in config:
-        del config[user_id_str]
-        save_config(config)
+    if get_store().delete_user(user_id):
         logger.info(f"Usuario {user_id} eliminó su configuración")
         return True
     return False
+
+def shutdown():
+    """Vuelca los cambios pendientes y cierra el backend (al apagar el bot)."""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+atexit.register(shutdown)
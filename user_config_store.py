@@ -0,0 +1,429 @@
+import json
+import os
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+JSON_CONFIG_FILE = "users_config.json"
+SQLITE_CONFIG_FILE = "users_config.db"
+
+# Campos con columna propia en SQLite; el resto va serializado en "extra"
+USER_FIELDS = ("gemini_api_key", "notion_token", "current_db_alias", "created_at", "updated_at")
+
+def default_user_config():
+    """Crea una configuración por defecto para un nuevo usuario."""
+    return {
+        "gemini_api_key": None,
+        "notion_token": None,
+        "notion_databases": {},
+        "current_db_alias": None,
+        "created_at": datetime.now().isoformat()
+    }
+
+def write_json_atomic(path, data):
+    """Escribe data en path vía archivo temporal + fsync + rename atómico."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows no permite abrir directorios
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class JsonUserConfigStore:
+    """
+    Backend sobre users_config.json.
+    Mantiene una copia en memoria compartida por el proceso y solo vuelve
+    a leer el archivo si cambia en disco (inode/mtime/tamaño).
+
+    Con flush_interval > 0 funciona en modo write-behind: cada cambio se
+    añade a un journal (una línea JSON por usuario modificado) y un hilo en
+    segundo plano agrupa los cambios de esa ventana en una única escritura
+    atómica del archivo completo. Al arrancar se reaplica el journal.
+    """
+
+    def __init__(self, path=JSON_CONFIG_FILE, flush_interval=0):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.flush_interval = flush_interval
+        self._cache = None
+        self._cache_stamp = None
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._journal = None
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._flusher = None
+
+    def _file_stamp(self):
+        """Devuelve la firma (inode, mtime, tamaño) del archivo o None si no existe."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load_all(self):
+        """Devuelve la configuración de todos los usuarios."""
+        with self._lock:
+            stamp = self._file_stamp()
+            if self._cache is not None and (stamp == self._cache_stamp or self._dirty):
+                return self._cache
+            config = {}
+            if stamp is not None:
+                try:
+                    with open(self.path, "r") as f:
+                        config = json.load(f)
+                except Exception as e:
+                    logger.error(f"Error cargando {self.path}: {e}", exc_info=True)
+                    stamp = None
+            self._cache, self._cache_stamp = config, stamp
+            if self._replay_journal(config):
+                self._mark_dirty()
+            return self._cache
+
+    def _replay_journal(self, config):
+        """Reaplica los cambios del journal que aún no llegaron al archivo."""
+        if not os.path.exists(self.journal_path):
+            return 0
+        replayed = 0
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Última línea a medio escribir si el proceso murió
+                    logger.warning(f"Línea de journal ignorada en {self.journal_path}")
+                    continue
+                if "all" in record:
+                    config.clear()
+                    config.update(record["all"])
+                elif record.get("config") is None:
+                    config.pop(record["user_id"], None)
+                else:
+                    config[record["user_id"]] = record["config"]
+                replayed += 1
+        if replayed:
+            logger.info(f"Reaplicados {replayed} cambio(s) del journal de {self.path}")
+        return replayed
+
+    def _append_journal(self, record):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a")
+        self._journal.write(json.dumps(record) + "\n")
+        # Sin fsync: sobrevive a la caída del proceso; el fsync lo hace el flush
+        self._journal.flush()
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="user-config-flusher", daemon=True
+            )
+            self._flusher.start()
+        self._wakeup.set()
+
+    def _commit(self, record):
+        """Persiste un cambio ya aplicado a la copia en memoria."""
+        if self.flush_interval <= 0:
+            self._dirty = True
+            self.flush()
+            return
+        self._append_journal(record)
+        self._mark_dirty()
+
+    def _flush_loop(self):
+        while not self._closing:
+            self._wakeup.wait()
+            if self._closing:
+                break
+            # Ventana de agrupación: los cambios que lleguen mientras tanto
+            # salen en la misma escritura
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Si el hilo muriera, los cambios quedarían solo en el journal
+                # hasta reiniciar: se registra y se sigue en la próxima vuelta
+                logger.error(f"Error en el volcado de {self.path}: {e}", exc_info=True)
+
+    def flush(self):
+        """Escribe la copia en memoria de forma atómica y recorta el journal."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = json.dumps(self._cache, indent=2)
+                # Todo lo escrito hasta ahora en el journal ya está en data
+                journal_offset = self._journal.tell() if self._journal else self._journal_size()
+                self._dirty = False
+            try:
+                write_json_atomic(self.path, data)
+            except Exception as e:
+                logger.error(f"Error guardando {self.path}: {e}", exc_info=True)
+                with self._lock:
+                    self._dirty = True
+                return
+            with self._lock:
+                self._cache_stamp = self._file_stamp()
+                self._truncate_journal(journal_offset)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _truncate_journal(self, offset):
+        """Descarta del journal lo que ya está incluido en el archivo."""
+        if self._journal is None and not os.path.exists(self.journal_path):
+            return
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        try:
+            with open(self.journal_path, "r") as f:
+                f.seek(offset)
+                pending = f.read()
+        except FileNotFoundError:
+            # Borrado desde fuera: no queda nada que recortar
+            return
+        if pending:
+            write_json_atomic(self.journal_path, pending)
+        else:
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+
+    def save_all(self, config):
+        """Reemplaza la configuración de todos los usuarios."""
+        with self._lock:
+            self._cache = config
+            self._commit({"all": config})
+
+    def get_user(self, user_id):
+        return self.load_all().get(str(user_id))
+
+    def upsert_user(self, user_id, fields):
+        """Actualiza campos de un usuario, creándolo si no existe."""
+        with self._lock:
+            config = self.load_all()
+            user_config = config.setdefault(str(user_id), default_user_config())
+            user_config.update(fields)
+            self._commit({"user_id": str(user_id), "config": user_config})
+
+    def add_database(self, user_id, alias, db_id):
+        """Añade una BD y la marca como activa si el usuario no tenía ninguna."""
+        with self._lock:
+            config = self.load_all()
+            user_config = config.setdefault(str(user_id), default_user_config())
+            user_config.setdefault("notion_databases", {})[alias] = db_id
+            if not user_config.get("current_db_alias"):
+                user_config["current_db_alias"] = alias
+            self._commit({"user_id": str(user_id), "config": user_config})
+
+    def delete_user(self, user_id):
+        with self._lock:
+            config = self.load_all()
+            if str(user_id) not in config:
+                return False
+            del config[str(user_id)]
+            self._commit({"user_id": str(user_id), "config": None})
+            return True
+
+    def close(self):
+        """Detiene el hilo de escritura y vuelca los cambios pendientes."""
+        self._closing = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+class SqliteUserConfigStore:
+    """
+    Backend SQLite: una fila por usuario y una tabla de BDs indexada por
+    (user_id, alias). Cada cambio es un upsert de una sola fila.
+    """
+
+    def __init__(self, path=SQLITE_CONFIG_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                gemini_api_key TEXT,
+                notion_token TEXT,
+                current_db_alias TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS user_databases (
+                user_id TEXT NOT NULL,
+                alias TEXT NOT NULL,
+                db_id TEXT NOT NULL,
+                PRIMARY KEY (user_id, alias)
+            );
+        """)
+
+    def _row_to_config(self, row, databases):
+        user_config = dict(zip(USER_FIELDS, row[1:6]))
+        if user_config["updated_at"] is None:
+            del user_config["updated_at"]
+        user_config["notion_databases"] = databases
+        if row[6]:
+            user_config.update(json.loads(row[6]))
+        return user_config
+
+    def get_user(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id, gemini_api_key, notion_token, current_db_alias, created_at, updated_at, extra "
+                "FROM users WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+            if not row:
+                return None
+            databases = dict(self._conn.execute(
+                "SELECT alias, db_id FROM user_databases WHERE user_id = ? ORDER BY rowid",
+                (str(user_id),)
+            ).fetchall())
+        return self._row_to_config(row, databases)
+
+    def load_all(self):
+        """Devuelve la configuración de todos los usuarios (para exportar o migrar)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, gemini_api_key, notion_token, current_db_alias, created_at, updated_at, extra "
+                "FROM users"
+            ).fetchall()
+            databases = {}
+            for user_id, alias, db_id in self._conn.execute(
+                "SELECT user_id, alias, db_id FROM user_databases ORDER BY rowid"
+            ):
+                databases.setdefault(user_id, {})[alias] = db_id
+        return {row[0]: self._row_to_config(row, databases.get(row[0], {})) for row in rows}
+
+    def _ensure_user(self, user_id):
+        defaults = default_user_config()
+        self._conn.execute(
+            "INSERT OR IGNORE INTO users (user_id, created_at) VALUES (?, ?)",
+            (str(user_id), defaults["created_at"])
+        )
+
+    def upsert_user(self, user_id, fields):
+        """Actualiza campos de un usuario, creándolo si no existe."""
+        columns = {k: v for k, v in fields.items() if k in USER_FIELDS}
+        extra = {k: v for k, v in fields.items() if k not in USER_FIELDS and k != "notion_databases"}
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._ensure_user(user_id)
+                if columns:
+                    assignments = ", ".join(f"{name} = ?" for name in columns)
+                    self._conn.execute(
+                        f"UPDATE users SET {assignments} WHERE user_id = ?",
+                        (*columns.values(), str(user_id))
+                    )
+                if extra:
+                    row = self._conn.execute(
+                        "SELECT extra FROM users WHERE user_id = ?", (str(user_id),)
+                    ).fetchone()
+                    merged = json.loads(row[0]) if row[0] else {}
+                    merged.update(extra)
+                    self._conn.execute(
+                        "UPDATE users SET extra = ? WHERE user_id = ?",
+                        (json.dumps(merged), str(user_id))
+                    )
+                for alias, db_id in fields.get("notion_databases", {}).items():
+                    self._conn.execute(
+                        "INSERT INTO user_databases (user_id, alias, db_id) VALUES (?, ?, ?) "
+                        "ON CONFLICT (user_id, alias) DO UPDATE SET db_id = excluded.db_id",
+                        (str(user_id), alias, db_id)
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def add_database(self, user_id, alias, db_id):
+        """Añade una BD y la marca como activa si el usuario no tenía ninguna."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._ensure_user(user_id)
+                self._conn.execute(
+                    "INSERT INTO user_databases (user_id, alias, db_id) VALUES (?, ?, ?) "
+                    "ON CONFLICT (user_id, alias) DO UPDATE SET db_id = excluded.db_id",
+                    (str(user_id), alias, db_id)
+                )
+                self._conn.execute(
+                    "UPDATE users SET current_db_alias = ? WHERE user_id = ? AND current_db_alias IS NULL",
+                    (alias, str(user_id))
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_user(self, user_id):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM user_databases WHERE user_id = ?", (str(user_id),))
+                deleted = self._conn.execute(
+                    "DELETE FROM users WHERE user_id = ?", (str(user_id),)
+                ).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted > 0
+
+    def import_config(self, config):
+        """Importa un diccionario con el formato de users_config.json."""
+        for user_id, user_config in config.items():
+            self.upsert_user(user_id, user_config)
+        return len(config)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def create_store(backend=None):
+    """Crea el backend indicado (o el de USER_CONFIG_BACKEND: json | sqlite)."""
+    backend = (backend or os.getenv("USER_CONFIG_BACKEND") or "json").lower()
+    if backend == "sqlite":
+        return SqliteUserConfigStore(os.getenv("USER_CONFIG_DB", SQLITE_CONFIG_FILE))
+    if backend != "json":
+        logger.warning(f"Backend de configuración desconocido '{backend}', usando json")
+    flush_interval = float(os.getenv("USER_CONFIG_FLUSH_INTERVAL", "0.5"))
+    return JsonUserConfigStore(JSON_CONFIG_FILE, flush_interval=flush_interval)
@@ -0,0 +1,95 @@
+import os
+import logging
+from dataclasses import dataclass, field
+import config_manager
+import gemini_pool
+import notion_pool
+import user_config_manager
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class UserSession:
+    """
+    Credenciales y BD activa de un usuario, resueltas una sola vez por update.
+    Evalúa la cadena de fallbacks (usuario → config.json → .env) una vez; la
+    BD de .env solo la usa la sesión global. Los clientes no se guardan en
+    la sesión: cada acceso los toma de su pool.
+    """
+    user_id: object
+    notion_token: str = None
+    gemini_api_key: str = None
+    database_id: str = None
+    db_alias: str = None
+    databases: dict = field(default_factory=dict)
+
+    @classmethod
+    def resolve(cls, user_id=None):
+        """Resuelve la sesión de un usuario (o la global si user_id es None)."""
+        user_config = user_config_manager.get_user_config(user_id) if user_id else None
+        user_config = user_config or {}
+
+        gemini_api_key = user_config.get("gemini_api_key")
+        if not gemini_api_key:
+            gemini_api_key = os.getenv("DEFAULT_GEMINI_API_KEY") or os.getenv("GEMINI_API_KEY")
+            if gemini_api_key and user_id:
+                logger.warning(f"Usuario {user_id} usando Gemini API key global (fallback)")
+
+        notion_token = user_config.get("notion_token")
+        if not notion_token:
+            notion_token = os.getenv("NOTION_INTEGRATION_TOKEN")
+            if notion_token and user_id:
+                logger.warning(f"Usuario {user_id} usando Notion token global (fallback)")
+
+        if user_config:
+            databases = user_config.get("notion_databases", {})
+            db_alias = user_config.get("current_db_alias")
+        else:
+            # Fallback a config_manager antiguo (se lee una sola vez)
+            legacy = config_manager.load_config()
+            databases = legacy.get("databases", {})
+            db_alias = legacy.get("current_db_alias")
+
+        database_id = databases.get(db_alias) if db_alias else None
+        if not database_id and user_config:
+            legacy = config_manager.load_config()
+            legacy_alias = legacy.get("current_db_alias")
+            if legacy_alias:
+                database_id = legacy.get("databases", {}).get(legacy_alias)
+        if not database_id and not user_id:
+            # Solo la sesión global usa la BD del operador: un usuario sin BD
+            # propia no debe leer ni escribir en ella
+            database_id = os.getenv("NOTION_DATABASE_ID")
+
+        return cls(
+            user_id=user_id,
+            notion_token=notion_token,
+            gemini_api_key=gemini_api_key,
+            database_id=database_id,
+            db_alias=db_alias,
+            databases=databases
+        )
+
+    @property
+    def notion_client(self):
+        """
+        Cliente de Notion del usuario, tomado del pool compartido por token.
+        No se guarda en la sesión: si el pool lo expulsó, se obtiene uno vivo.
+        """
+        return notion_pool.get_client(self.notion_token) if self.notion_token else None
+
+    @property
+    def notion_async_client(self):
+        """AsyncClient de Notion del usuario, tomado del pool compartido por token."""
+        return notion_pool.get_async_client(self.notion_token) if self.notion_token else None
+
+    @property
+    def gemini_clients(self):
+        """Clientes de Gemini de la key del usuario, desde el pool compartido."""
+        return gemini_pool.get_clients(self.gemini_api_key) if self.gemini_api_key else None
+
+    @property
+    def gemini_model(self):
+        """Modelo de Gemini ligado a la key del usuario (sin configuración global)."""
+        clients = self.gemini_clients
+        return clients.model if clients else None